@@ -1,15 +1,21 @@
 # ======================================
 # app.py - v4.5 (Admin 篩選 - 中文日誌)
 # ======================================
-from flask import Flask, request, jsonify, send_file, render_template
+from flask import Flask, request, jsonify, render_template, g
+from flask.json.provider import DefaultJSONProvider
 from flask_cors import CORS
 from s3_store import S3Store
 from pathlib import Path
-import os, io, csv, uuid, jwt
+import os, uuid, jwt, base64, hashlib
+from bisect import bisect_left
+from itertools import islice
 from datetime import datetime, timezone, timedelta
-from functools import wraps
-import json
+from functools import wraps, lru_cache
+from concurrent.futures import ThreadPoolExecutor, wait
 import logging 
+import threading
+import time
+import orjson
 from flask_limiter import Limiter
 from flask_limiter.util import get_remote_address
 from botocore.exceptions import ClientError
@@ -32,7 +38,25 @@ ENABLE_ADMIN_AUTH = os.environ.get('ENABLE_ADMIN_AUTH', 'false').lower() == 'tru
 PROJECT_DIR = Path(__file__).resolve().parent
 TEMPLATES_DIR = PROJECT_DIR / "templates"
 
+# ---------- (新) orjson 序列化 ----------
+class OrjsonProvider(DefaultJSONProvider):
+    """jsonify 與 request.get_json 改用 orjson (C/Rust 實作) 序列化/解析，大型清單回應明顯較快"""
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, default=self.default, option=orjson.OPT_NON_STR_KEYS).decode("utf-8")
+
+    def loads(self, s, **kwargs):
+        # orjson 直接接受 bytes，不必先解碼成 str；解析錯誤為 ValueError 子類別，Flask 照常回 400
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        # (優化) jsonify 直接以 orjson 產生的 bytes 建立回應，不經 dumps 解碼成 str 再由 Response 編碼回 bytes
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(
+            orjson.dumps(obj, default=self.default, option=orjson.OPT_NON_STR_KEYS), mimetype=self.mimetype
+        )
+
 app = Flask(__name__, template_folder=str(TEMPLATES_DIR), static_folder="static")
+app.json = OrjsonProvider(app)
 CORS(app)
 
 # ---------- S3 儲存初始化 ----------
@@ -40,12 +64,42 @@ s3_store = S3Store()
 
 MAX_PER_BOOKING = 3
 
+# (新) 請求內並行 S3 I/O 用的執行緒池（執行緒於第一次 submit 時才建立）
+_io_pool = ThreadPoolExecutor(max_workers=8, thread_name_prefix="s3-io")
+
+# ---------- (新) 固定回應預先序列化 ----------
+_HEALTH_BODY = orjson.dumps({"ok": True})
+_TOKEN_VALID_BODY = orjson.dumps({"success": True, "message": "Token valid"})
+_EMPTY_STATUS_BODY = orjson.dumps({"tables": []})
+_EMPTY_TABLES_BODY = orjson.dumps([])
+_EMPTY_AVAILABILITY_BODY = orjson.dumps({"holds": [], "confirmed": []})
+# 訂位高峰時大部分請求都以這幾種拒絕結束
+_TABLE_NOT_FOUND_BODY = orjson.dumps({"success": False, "message": "Table not found"})
+_TABLE_FULL_BODY = orjson.dumps({"success": False, "message": "This table is full or seats are not enough now."})
+_IDEM_IN_PROGRESS_BODY = orjson.dumps({"success": False, "message": "This request is already being processed."})
+_LOGIN_TAKEN_BODY = orjson.dumps({"success": False, "message": "This login_id already has a reservation."})
+_CAS_CONFLICT_BODY = orjson.dumps({
+    "success": False, "message": "You were too slow! That seat was just taken. Please select another."
+})
+_VERSION_BODY = orjson.dumps({
+    "app_version": APP_VERSION,
+    "s3_store_version": S3Store.VERSION
+})
+
+def _json_bytes_response(body, status=200):
+    """直接以已序列化的 JSON bytes 建立回應（略過 jsonify）"""
+    return app.response_class(body, status=status, mimetype="application/json")
+
 # ---------- (新) 速率限制設定 ----------
 def get_ip_address():
-    if 'X-Forwarded-For' in request.headers:
-        return request.headers['X-Forwarded-For'].split(',')[0].strip()
-    else:
-        return request.remote_addr
+    # (優化) 使用 Werkzeug 已解析的 access_route (X-Forwarded-For)，
+    # 並在同一個請求內記住結果 (limiter 與 429 handler 共用)
+    ip = getattr(g, "_ip", None)
+    if ip is None:
+        route = request.access_route
+        ip = route[0] if route else request.remote_addr
+        g._ip = ip
+    return ip
 
 limiter = Limiter(
     app=app,
@@ -55,6 +109,17 @@ limiter = Limiter(
 )
 
 # ---------- Token 驗證裝飾器 ----------
+# (優化) 相同 token 只做一次 HMAC 驗證；命中快取時仍檢查 exp，過期 token 一律拒絕
+@lru_cache(maxsize=1024)
+def _decode_admin_token(token):
+    return jwt.decode(token, JWT_SECRET, algorithms=['HS256'], options={"require": ["exp"]})
+
+def _verify_admin_token(token):
+    payload = _decode_admin_token(token)
+    if payload['exp'] < time.time():
+        raise jwt.ExpiredSignatureError("Signature has expired")
+    return payload
+
 def require_admin_token(f):
     @wraps(f)
     def decorated(*args, **kwargs):
@@ -64,8 +129,10 @@ def require_admin_token(f):
         if not token:
             return jsonify({'success': False, 'message': 'No token provided'}), 401
         try:
-            token = token.replace('Bearer ', '')
-            payload = jwt.decode(token, JWT_SECRET, algorithms=['HS256'])
+            # 只去除開頭的 "Bearer " 前綴 (replace 會掃描整串並配置新字串)
+            if token.startswith('Bearer '):
+                token = token[7:]
+            payload = _verify_admin_token(token)
             if payload.get('username') != ADMIN_USERNAME:
                 return jsonify({'success': False, 'message': 'Invalid token'}), 401
         except jwt.ExpiredSignatureError:
@@ -75,23 +142,87 @@ def require_admin_token(f):
         return f(*args, **kwargs)
     return decorated
 
+# ---------- (新) 讀取端回應快取 ----------
+# /api/status 的完整回應 bytes；以 tables_data 快取物件 (及舊格式時的預訂摘要) 的身分為鍵，
+# S3Store 快取更新（換成新物件）時才重新組裝與序列化
+_status_cache = None  # (tables_data 物件, 預訂摘要 dict 物件或 None, body_bytes, etag)
+_status_lock = threading.Lock()
+# /api/tables 與 /api/reservations/availability 同理，以 tables_data 快取物件的身分為鍵
+# (S3Store 的 TTL 讓其他 worker 的寫入也能在數秒內反映)
+# 本程序寫入 tables.json 時會以新物件更新 S3Store 快取，鍵自然失效，寫入類 API 不必另外清除
+_tables_body_cache = None  # (tables_data 物件, body_bytes, etag)
+_availability_cache = None  # (tables_data 物件, body_bytes, etag)
+
+# ---------- (新) 桌號排序快取 ----------
+# 桌號集合幾乎不變，不必每次請求都 sorted(..., key=int)；
+# 與回應快取相同，以 tables_data 快取物件的身分為鍵，命中時不必逐一比對桌號
+_sorted_table_keys_cache = None  # (tables_data 物件, tuple(sorted_keys))
+
+def _sorted_table_keys(tables_data):
+    """回傳依數字排序的桌號 tuple；同一個 tables_data 物件重用上次結果"""
+    global _sorted_table_keys_cache
+    cached = _sorted_table_keys_cache
+    if cached is None or cached[0] is not tables_data:
+        cached = (tables_data, tuple(sorted(tables_data, key=int)))
+        _sorted_table_keys_cache = cached
+    return cached[1]
+
 # ---------- 輔助函式 (保持不變) ----------
+def _reservation_date(reservation):
+    # ISO-8601 的前 10 個字元即為 YYYY-MM-DD，直接切片，不必整串解析
+    date_str = (reservation.get("created_at") or "")[:10]
+    if len(date_str) == 10 and date_str[4] == '-' and date_str[7] == '-':
+        return date_str
+    logger.error(f"無法從 {reservation.get('id')} 解析日期: {reservation.get('created_at')!r}")
+    return datetime.now(TAIWAN_TZ).strftime('%Y-%m-%d')
+
+def _public_reservation(reservation):
+    """去除快取用的私有欄位 (底線開頭) 後再回傳給前端"""
+    # (優化) 快取的預訂只會帶 _tid_str 這個私有欄位：複製後移除即可，不必逐一檢查每個 key
+    public = dict(reservation)
+    public.pop('_tid_str', None)
+    return public
+
 def _find_reservation_and_date(reservation_id):
     if not reservation_id:
         return None, None
-    all_reservations = s3_store.get_all_reservations()
-    reservation = next((r for r in all_reservations if r.get('id') == reservation_id), None)
-    if not reservation:
-        return None, None
-    try:
-        created_at_iso = reservation.get("created_at")
-        created_dt = datetime.fromisoformat(created_at_iso)
-        date_str = created_dt.strftime('%Y-%m-%d')
-        return reservation, date_str
-    except Exception as e:
-        logger.error(f"無法從 {reservation_id} 解析日期: {e}")
-        date_str = datetime.now(TAIWAN_TZ).strftime('%Y-%m-%d')
-        return reservation, date_str
+    # (優化) 以 id 直接查日期索引再 GET 該筆預訂，不再讀取/掃描全部預訂
+    # (無索引的舊資料由 S3Store 列出 key 找到日期後補寫索引)
+    return s3_store.get_reservation_with_date(reservation_id)
+
+# ---------- (新) 桌位預訂摘要 ----------
+# tables.json 每張桌子附帶 "reservations": [{"id", "name", "seats"}]，
+# 與 seats_left 在同一次 CAS 寫入中維護，/api/status 只需讀取 tables.json
+def _summary_entry(reservation_id, name, seats):
+    return {"id": reservation_id, "name": name, "seats": seats}
+
+def _has_table_summaries(tables_data):
+    return all("reservations" in t for t in tables_data.values())
+
+def _resync_tables(tables_data, all_reservations):
+    """依實際預訂重算每張桌子的 seats_left 與預訂摘要（就地修改）；回傳被修正的桌數"""
+    entries_by_table = {}
+    for r in all_reservations:
+        entries_by_table.setdefault(r["_tid_str"], []).append(
+            _summary_entry(r.get("id"), r.get("employee_name", "Unknown"), r.get("seats_taken", 1))
+        )
+    by_id = lambda e: e.get("id") or ""
+    updated_count = 0
+    for table_id_str, table in tables_data.items():
+        entries = entries_by_table.get(table_id_str, [])
+        new_seats_left = table.get("total", 10) - sum(e["seats"] for e in entries)
+        changed = False
+        if table["seats_left"] != new_seats_left:
+            logger.info(f"[RESYNC] 桌號 {table_id_str}: 剩餘座位 {table['seats_left']}, 修正為 {new_seats_left}")
+            table["seats_left"] = new_seats_left
+            changed = True
+        if "reservations" not in table or sorted(table["reservations"], key=by_id) != sorted(entries, key=by_id):
+            logger.info(f"[RESYNC] 桌號 {table_id_str}: 重建預訂摘要 ({len(entries)} 筆)")
+            table["reservations"] = entries
+            changed = True
+        if changed:
+            updated_count += 1
+    return updated_count
 
 # ---------- 初始化桌位資料 (保持不變) ----------
 def init_tables():
@@ -99,34 +230,40 @@ def init_tables():
         existing_tables = s3_store.get_tables_data()
         if existing_tables:
             print("[INFO] S3 中已存在桌位資料")
+            # 舊版 tables.json 尚無預訂摘要時，依現有預訂補上一次
+            # (先讀 tables.json 再重新讀取預訂：之後的預訂會讓 CAS 失敗，不會被覆寫掉)
+            tables_data, etag = None, None
+            if not _has_table_summaries(existing_tables):
+                tables_data, etag = s3_store.get_tables_data_with_etag()
+            # 舊預訂可能尚無 login_id 標記，啟動時補寫一次
+            all_reservations = s3_store.get_all_reservations(fresh=True)
+            s3_store.rebuild_login_markers(reservations=all_reservations)
+            if tables_data:
+                _resync_tables(tables_data, all_reservations)
+                s3_store.save_tables_data_cas(tables_data, etag)
+                print("[INFO] 已補上桌位預訂摘要")
             return
-        tables_data = {}
-        for i in range(1, 109):
-            tables_data[str(i)] = {
-                "id": i,
-                "name": f"Table {i}",
-                "total": 10,
-                "seats_left": 10
-            }
-        if s3_store.save_tables_data(tables_data):
+        tables_data = {
+            str(i): {"id": i, "name": f"Table {i}", "total": 10, "seats_left": 10, "reservations": []}
+            for i in range(1, 109)
+        }
+        # (優化) 一次條件寫入建立整份桌位資料：多個執行個體同時啟動時只有一個會寫入，
+        # 不會蓋掉別人剛建立 (甚至已有人預訂) 的 tables.json
+        if s3_store.save_tables_data(tables_data, create_only=True):
             print("[INFO] 已在 S3 中初始化桌位 (1..108)")
         else:
-            print("[WARN] 在 S3 中初始化桌位失敗")
+            print("[WARN] 在 S3 中初始化桌位失敗 (或已由其他執行個體建立)")
     except Exception as e:
         print(f"[WARN] init_tables 失敗: {e}")
 
-try:
-    init_tables()
-except Exception as e:
-    print(f"[WARN] init_tables 已跳過: {e}")
+# (優化) 不在 import 時呼叫 init_tables()：
+# 正式環境由 gunicorn.conf.py 的 on_starting hook 於 master 執行一次，
+# 本機開發則由下方 __main__ 執行。
 
 # ---------- (NEW) 版本檢查 API ----------
 @app.route("/api/version")
 def get_version():
-    return jsonify(
-        app_version=APP_VERSION, 
-        s3_store_version=getattr(s3_store, 'VERSION', 'unknown')
-    )
+    return _json_bytes_response(_VERSION_BODY)
 
 # ---------- 頁面路由 (保持不變) ----------
 @app.route("/")
@@ -152,7 +289,7 @@ def reports_page():
 # ---------- 健康檢查 ----------
 @app.get("/health")
 def health():
-    return jsonify(ok=True)
+    return _json_bytes_response(_HEALTH_BODY)
 
 # ---------- S3 連線測試 ----------
 @app.route('/test-s3')
@@ -181,60 +318,144 @@ def admin_login():
 @app.get("/api/admin/verify")
 @require_admin_token
 def admin_verify():
-    return jsonify({'success': True, 'message': 'Token valid'})
+    return _json_bytes_response(_TOKEN_VALID_BODY)
+
+# ---------- (新) 條件式 GET (ETag / If-None-Match) ----------
+# 快取的回應 bytes 同時保存其 ETag；輪詢的前端帶 If-None-Match 且內容未變時只回 304，不送 body
+def _body_etag(body):
+    return hashlib.blake2b(body, digest_size=16).hexdigest()
+
+def _conditional_json_response(body, etag):
+    resp = _json_bytes_response(body)
+    if etag is not None:
+        resp.set_etag(etag)
+        resp = resp.make_conditional(request)
+    return resp
 
 # ---------- API：座位狀態 (!!! 已優化 !!!) ----------
 @app.get("/api/status")
 def api_status():
+    return _conditional_json_response(*_status_body())
+
+def _status_body():
+    """回傳 /api/status 的 (body_bytes, etag)"""
     tables_data = s3_store.get_tables_data()
     if not tables_data:
-        return jsonify({"tables": []})
-    all_reservations = s3_store.get_all_reservations()
-    reservations_map = {}
-    for r in all_reservations:
-        table_id_str = str(r.get("table_id"))
-        name = r.get("employee_name", "Unknown")
-        seats = r.get("seats_taken", 1) 
-        if table_id_str not in reservations_map:
-            reservations_map[table_id_str] = []
-        reservations_map[table_id_str].append({ "name": name, "seats": seats })
-    tables_list = []
-    for table_id_str in sorted(tables_data.keys(), key=int):
-        table = tables_data[table_id_str]
-        reservation_list = reservations_map.get(table_id_str, []) 
-        tables_list.append({
-            "table_id": table["id"],
-            "seats_left": table["seats_left"],
-            "reservations": reservation_list
-        })
-    return jsonify({"tables": tables_list})
-
-# ---------- API：桌位清單 (保持不變) ----------
+        return _EMPTY_STATUS_BODY, None
+    cached = _status_cache
+    if cached is not None and cached[0] is tables_data and (
+            cached[1] is None or cached[1] is s3_store.get_reservation_summary()):
+        return cached[2], cached[3]
+    return _build_status_body(tables_data)
+
+def _build_status_body(tables_data):
+    """重建 /api/status 回應；同時到達的請求只由第一個組裝，其餘等待並共用結果"""
+    global _status_cache
+    with _status_lock:
+        # tables.json 已帶預訂摘要時只需這一份資料；舊格式才退回讀取全部預訂
+        summary = None if _has_table_summaries(tables_data) else s3_store.get_reservation_summary()
+        cached = _status_cache
+        if cached is not None and cached[0] is tables_data and cached[1] is summary:
+            return cached[2], cached[3]
+        if summary is None:
+            tables_list = [
+                {
+                    "table_id": tables_data[k]["id"],
+                    "seats_left": tables_data[k]["seats_left"],
+                    "reservations": [{"name": e["name"], "seats": e["seats"]} for e in tables_data[k]["reservations"]]
+                }
+                for k in _sorted_table_keys(tables_data)
+            ]
+        else:
+            tables_list = [
+                {
+                    "table_id": tables_data[k]["id"],
+                    "seats_left": tables_data[k]["seats_left"],
+                    "reservations": summary.get(k, [])
+                }
+                for k in _sorted_table_keys(tables_data)
+            ]
+        body = orjson.dumps({"tables": tables_list})
+        etag = _body_etag(body)
+        _status_cache = (tables_data, summary, body, etag)
+        return body, etag
+
+# ---------- API：桌位清單 ----------
 @app.get("/api/tables")
 def api_tables():
+    return _conditional_json_response(*_tables_body())
+
+def _tables_body():
+    """回傳 /api/tables 的 (body_bytes, etag)"""
+    global _tables_body_cache
     tables_data = s3_store.get_tables_data()
     if not tables_data:
-        return jsonify([])
+        return _EMPTY_TABLES_BODY, None
+    cached = _tables_body_cache
+    if cached is not None and cached[0] is tables_data:
+        return cached[1], cached[2]
     tables_list = []
-    for table_id in sorted(tables_data.keys(), key=int):
+    for table_id in _sorted_table_keys(tables_data):
         table = tables_data[table_id]
         tables_list.append({
             "id": table["id"], "name": table["name"],
             "total": table["total"], "seats_left": table["seats_left"]
         })
-    return jsonify(tables_list)
+    body = orjson.dumps(tables_list)
+    etag = _body_etag(body)
+    _tables_body_cache = (tables_data, body, etag)
+    return body, etag
 
 # ---------- API：可用性 (保持不變) ----------
 @app.get("/api/reservations/availability")
 def api_availability():
+    return _conditional_json_response(*_availability_body())
+
+def _availability_body():
+    """回傳 /api/reservations/availability 的 (body_bytes, etag)"""
+    global _availability_cache
     tables_data = s3_store.get_tables_data()
     if not tables_data:
-        return jsonify({"holds": [], "confirmed": []})
-    confirmed = []
-    for table_id, table in tables_data.items():
-        if table["seats_left"] <= 0:
-            confirmed.append({"table_id": table["id"]})
-    return jsonify({"holds": [], "confirmed": confirmed})
+        return _EMPTY_AVAILABILITY_BODY, None
+    cached = _availability_cache
+    if cached is not None and cached[0] is tables_data:
+        return cached[1], cached[2]
+    confirmed = [{"table_id": t["id"]} for t in tables_data.values() if t["seats_left"] <= 0]
+    body = orjson.dumps({"holds": [], "confirmed": confirmed})
+    etag = _body_etag(body)
+    _availability_cache = (tables_data, body, etag)
+    return body, etag
+
+# ---------- (新) API：合併讀取 ----------
+# 前端一次輪詢即可取得多個讀取端回應；各部分直接重用其已快取的序列化 bytes 拼接，不重新編碼
+_BATCH_PARTS = {
+    "status": lambda: _status_body()[0],
+    "tables": lambda: _tables_body()[0],
+    "availability": lambda: _availability_body()[0],
+}
+
+@app.get("/api/batch")
+def api_batch():
+    names = request.args.get("parts", "status,tables,availability").split(",")
+    parts = [
+        b'"%s":%s' % (name.encode(), _BATCH_PARTS[name]())
+        for name in dict.fromkeys(n.strip() for n in names) if name in _BATCH_PARTS
+    ]
+    return _json_bytes_response(b"{" + b",".join(parts) + b"}")
+
+# ---------- (新) 預約列表分頁游標 ----------
+_reservation_order_key = S3Store._reservation_order_key
+
+def _encode_page_token(reservation):
+    return base64.urlsafe_b64encode(orjson.dumps(_reservation_order_key(reservation))).decode()
+
+def _decode_page_token(token):
+    """還原 next_token 為 (created_at, id)；格式不符時回傳 None"""
+    try:
+        created_at, rid = orjson.loads(base64.urlsafe_b64decode(token.encode()))
+        return (str(created_at), str(rid))
+    except Exception:
+        return None
 
 # ---------- API：查詢預約 (!!! 已優化 & 公開 !!!) ----------
 @app.get("/api/reservations")
@@ -244,71 +465,151 @@ def list_reservations():
     table_id = request.args.get("table_id", type=int)
     page = max(1, request.args.get("page", default=1, type=int))
     size = min(100, max(1, request.args.get("page_size", default=50, type=int)))
+    # (新) 可選的日期範圍 (YYYY-MM-DD)，只讀取範圍內的日期資料夾
+    date_from = request.args.get("date_from")
+    date_to = request.args.get("date_to")
+    # (新) count_only=1 時只回傳筆數，不讀取預訂內容
+    count_only = request.args.get("count_only", type=int) == 1
+    next_token = request.args.get("next_token")
+    if next_token:
+        next_token = _decode_page_token(next_token)
+        if next_token is None:
+            return jsonify({"data": [], "total": 0, "page": page, "page_size": size, "error": "invalid next_token"}), 400
     try:
-        all_reservations = s3_store.get_all_reservations()
+        if date_from or date_to:
+            dates = [d for d in s3_store.list_reservation_dates()
+                     if (not date_from or d >= date_from) and (not date_to or d <= date_to)]
+            if count_only and not table_id:
+                return jsonify(total=s3_store.count_reservations(dates))
+            all_reservations = s3_store.get_reservations_for_dates(dates)
+        elif count_only and not table_id:
+            return jsonify(total=s3_store.count_reservations())
+        else:
+            all_reservations = s3_store.get_all_reservations()
         logger.debug(f"[DEBUG] 從快取/S3 找到 {len(all_reservations)} 筆預訂")
+        if count_only:
+            # 走到這裡必有 table_id：只計數，不建立篩選後的清單
+            return jsonify(total=sum(1 for r in all_reservations if r.get("table_id") == table_id))
         if table_id:
             all_reservations = [r for r in all_reservations if r.get("table_id") == table_id]
-        all_reservations.sort(key=lambda x: x.get("created_at", ""), reverse=True)
-        total = len(all_reservations)
-        start = (page - 1) * size
-        end = start + size
-        data = all_reservations[start:end]
-        return jsonify({
-            "data": data, "total": total,
+        # S3Store 回傳的清單已依 (created_at, id) 由舊到新排序，由尾端往前取頁
+        ordered = all_reservations
+        total = len(ordered)
+        if next_token:
+            # (新) next_token：從上一頁最後一筆之後接續，期間有新增/刪除也不會重複或漏列
+            end = bisect_left(ordered, next_token, key=_reservation_order_key)
+        else:
+            end = max(0, total - (page - 1) * size)
+        start = max(0, end - size)
+        page_items = ordered[start:end][::-1]
+        result = {
+            "data": [_public_reservation(r) for r in page_items], "total": total,
             "page": page, "page_size": size
-        })
+        }
+        if start > 0:
+            result["next_token"] = _encode_page_token(page_items[-1])
+        # (優化) 直接以 orjson 序列化成 bytes 回應，略過 jsonify 的 provider 轉派
+        return _json_bytes_response(orjson.dumps(result))
     except Exception as e:
         logger.error(f"[ERROR] list_reservations 失敗: {e}")
         return jsonify({ "data": [], "total": 0, "page": page, "page_size": size, "error": str(e) })
 
-# ---------- API：建立預約 (!!! 已優化 - CAS + 速率限制 !!!) ----------
-@app.post("/api/reserve")
-@limiter.limit("1 per 2 seconds") # (優化) 每 IP 2 秒只能請求一次
-def reserve():
-    payload = request.get_json(force=True)
+# ---------- (新) 訂位請求解析 ----------
+def _parse_reserve_payload(raw):
+    """
+    以 orjson 直接解析請求 body，並一次完成欄位轉型與檢查。
+    回傳 (table_id, seats, employee_name, login_id)；不合法時丟出 ValueError (訊息即回應內容)。
+    """
     try:
+        payload = orjson.loads(raw)
         table_id = int(payload["table_id"])
-        table_id_str = str(table_id) 
     except Exception:
-        return jsonify(success=False, message="table_id is required"), 400
-
-    seats = payload.get("seats_to_take", 1)
-    try: seats = int(seats)
-    except Exception: seats = 1
-
+        raise ValueError("table_id is required")
+    try:
+        seats = int(payload.get("seats_to_take", 1))
+    except Exception:
+        seats = 1
+    if seats < 1 or seats > MAX_PER_BOOKING:
+        raise ValueError(f"Invalid seat count (1-{MAX_PER_BOOKING})")
     employee_name = str(payload.get("employee_name", "")).strip() or "Guest"
     login_id = (str(payload.get("login_id", "")).strip() or "guest").lower()
+    return table_id, seats, employee_name, login_id
 
-    if seats < 1 or seats > MAX_PER_BOOKING:
-        return jsonify(success=False, message=f"Invalid seat count (1-{MAX_PER_BOOKING})"), 400
-
-    idem_key = request.headers.get("Idempotency-Key") or str(uuid.uuid4())
-
+# ---------- API：建立預約 (!!! 已優化 - CAS + 速率限制 !!!) ----------
+@app.post("/api/reserve")
+@limiter.limit("1 per 2 seconds") # (優化) 每 IP 2 秒只能請求一次
+def reserve():
     try:
-        # 1. 檢查防重複提交
-        existing_idem = s3_store.get_idempotency_key(idem_key)
-        if existing_idem:
-            return jsonify(success=True, message="Already processed",
-                           reservation_id=existing_idem.get("reservation_id")), 200
-
-        # 2. (優化) 檢查登入 ID
-        if s3_store.check_login_id_exists(login_id):
-            return jsonify(success=False, message="This login_id already has a reservation."), 409
+        table_id, seats, employee_name, login_id = _parse_reserve_payload(request.get_data(cache=False))
+    except ValueError as e:
+        return jsonify(success=False, message=str(e)), 400
+    table_id_str = str(table_id)
+
+    client_idem_key = request.headers.get("Idempotency-Key")
+    if not client_idem_key:
+        # (優化) 記憶體中的桌位快取已顯示座位不足時直接拒絕，不送出任何 S3 請求；
+        # 快取只作提前拒絕的參考，實際扣位仍以 CAS 為準。
+        # 帶 Idempotency-Key 的請求可能是已成功預訂的重送，仍要走完整流程回傳原結果
+        cached_tables = s3_store.peek_tables_data()
+        if cached_tables is not None:
+            cached_table = cached_tables.get(table_id_str)
+            if cached_table is None:
+                return _json_bytes_response(_TABLE_NOT_FOUND_BODY, 404)
+            if cached_table["seats_left"] < seats:
+                return _json_bytes_response(_TABLE_FULL_BODY, 409)
+
+    idem_key = client_idem_key or os.urandom(16).hex()
+    reservation_id = str(uuid.uuid4())
+    idem_claimed = False
+    login_claimed = False
+    seats_taken = False
+    committed = False
 
-        # 3. 取得 ETag
-        tables_data, etag = s3_store.get_tables_data_with_etag()
+    try:
+        # 1 + 2 + 3. (優化) 佔用防重複鍵、佔用登入 ID 與讀取桌位 (含 ETag) 互不相依，
+        # 三個 S3 請求同時送出，總等待時間約為最慢的一個
+        idem_future = _io_pool.submit(s3_store.claim_idempotency_key, idem_key)
+        claim_future = _io_pool.submit(s3_store.claim_login_id, login_id, reservation_id)
+        try:
+            tables_data, etag = s3_store.get_tables_data_with_etag()
+        finally:
+            # 兩個佔用都有結果後才往下判斷：其中一個拋錯時，另一個已成功的佔用仍要由 finally 釋放
+            wait((idem_future, claim_future))
+            idem_claimed = idem_future.exception() is None and idem_future.result() is None
+            login_claimed = claim_future.exception() is None and claim_future.result()
+        existing_idem = idem_future.result()
+        claim_future.result()
+
+        # 1. 檢查防重複提交 (條件寫入：同一個鍵同時送出的請求只有一個能佔用)
+        if existing_idem is not None:
+            idem_record = orjson.loads(existing_idem)
+            if idem_record.get("reservation_id"):
+                # (優化) 防重複鍵內容即為重送時的回應本身，直接回傳原始 bytes，不重新編碼
+                if "success" in idem_record:
+                    return _json_bytes_response(existing_idem)
+                # 舊格式只存 reservation_id
+                return jsonify(success=True, message="Already processed",
+                               reservation_id=idem_record["reservation_id"]), 200
+            return _json_bytes_response(_IDEM_IN_PROGRESS_BODY, 409)
+
+        # 2. (優化) login_id 以條件寫入先佔用：同時送出的重複 login_id 只有一個能成功；
+        # 之後任何失敗都會在 finally 釋放
+        if not login_claimed:
+            return _json_bytes_response(_LOGIN_TAKEN_BODY, 409)
         if not tables_data:
             return jsonify(success=False, message="Server error: Cannot read tables data"), 500
             
         # 4. 檢查座位
         if table_id_str not in tables_data:
-             return jsonify(success=False, message="Table not found"), 404
+             return _json_bytes_response(_TABLE_NOT_FOUND_BODY, 404)
         if tables_data[table_id_str]["seats_left"] < seats:
-            return jsonify(success=False, message="This table is full or seats are not enough now."), 409
+            return _json_bytes_response(_TABLE_FULL_BODY, 409)
 
-        # 5. 在記憶體中修改
-        tables_data[table_id_str]["seats_left"] -= seats
+        # 5. 在記憶體中修改 (座位數與該桌預訂摘要一起寫回)
+        table = tables_data[table_id_str]
+        table["seats_left"] -= seats
+        if "reservations" in table:
+            table["reservations"].append(_summary_entry(reservation_id, employee_name, seats))
 
         # 6. 嘗試原子性寫回 (CAS)
         try:
@@ -316,12 +617,13 @@ def reserve():
         except ClientError as e:
             if e.response['Error']['Code'] == 'PreconditionFailed':
                 logger.warning(f"CAS 409: S3 PreconditionFailed (幾乎同時提交) for Table {table_id_str}")
-                return jsonify(success=False, message="You were too slow! That seat was just taken. Please select another."), 409 
+                return _json_bytes_response(_CAS_CONFLICT_BODY, 409)
             else:
                 raise 
+        # 之後的失敗才需要歸還座位
+        seats_taken = True
         
         # 7. 建立預約
-        reservation_id = str(uuid.uuid4())
         reservation_data = {
             "id": reservation_id, "table_id": table_id, "seats_taken": seats,
             "employee_name": employee_name, "login_id": login_id,
@@ -329,29 +631,49 @@ def reserve():
         }
         logger.debug(f"[DEBUG] 正在建立預訂: {reservation_data}")
 
-        # 8. 儲存
-        if s3_store.save_reservation(reservation_id, reservation_data, date_str=None):
-            s3_store.save_idempotency_key(idem_key, {"reservation_id": reservation_id})
+        # 8. 儲存 (直接帶入日期，不必讓 S3Store 遍歷尋找)
+        # (優化) 防重複鍵結果、日期索引與預訂檔互不相依，三個寫入同時送出 (一個來回)；
+        # 預訂寫入失敗時刪除索引，防重複鍵由 finally 釋放
+        date_str = _reservation_date(reservation_data)
+        idem_future = _io_pool.submit(s3_store.save_idempotency_key, idem_key,
+                                      {"success": True, "message": "Already processed", "reservation_id": reservation_id})
+        index_future = _io_pool.submit(s3_store.put_slot_index, reservation_id, date_str)
+        saved = s3_store.save_reservation(reservation_id, reservation_data, date_str=date_str,
+                                          write_login_marker=False, write_slot_index=False)
+        if not idem_future.result():
+            # 結果沒寫進去時不要留下「處理中」的空鍵，否則重送會一直被擋
+            s3_store.delete_idempotency_key(idem_key)
+        index_future.result()
+        if saved:
+            committed = True
             logger.info(f"預訂成功建立: {reservation_id}")
             return jsonify(success=True, message="Reservation confirmed!",
                            reservation_id=reservation_id, table_id=table_id), 201
         else:
             # 復原 (Rollback)
             logger.warning(f"儲存預訂 {reservation_id} 失敗, 正在回復座位...")
-            s3_store.release_seats_cas(table_id, seats) 
+            seats_taken = False
+            s3_store.delete_reservation(reservation_id, date_str)
+            s3_store.release_seats_cas(table_id, seats, reservation_id=reservation_id)
             return jsonify(success=False, message="Failed to save reservation"), 500
 
     except Exception as e:
         logger.error(f"[ERROR] 預訂失敗: {e}")
         try:
-            if 'table_id' in locals():
-                s3_store.release_seats_cas(table_id, seats)
+            # 只有 CAS 已扣位時才歸還；扣位前的錯誤 (佔用、讀取桌位) 沒有動到座位
+            if seats_taken:
+                s3_store.release_seats_cas(table_id, seats, reservation_id=reservation_id)
                 logger.info(f"因錯誤 {e} 回復桌位 {table_id}")
-            else:
-                logger.error(f"因錯誤 {e} 預訂失敗，但 table_id 未定義，無法回復座位")
         except Exception as rollback_e:
             logger.error(f"[CRITICAL] 回復失敗! {rollback_e}")
         return jsonify(success=False, message=f"Reservation failed: {str(e)}"), 500
+    finally:
+        if not committed:
+            # 未完成的預訂釋放佔用，讓用戶端可以重試
+            if idem_claimed:
+                s3_store.delete_idempotency_key(idem_key)
+            if login_claimed:
+                s3_store.release_login_id(login_id)
 
 # ---------- API：取消預約 (!!! 已優化 - CAS !!!) ----------
 @app.post("/api/cancel")
@@ -364,8 +686,8 @@ def cancel():
     reservation, date_str = _find_reservation_and_date(reservation_id)
     if not reservation:
         return jsonify(success=False, message="Reservation not found"), 404
-    if s3_store.delete_reservation(reservation_id, date_str):
-        if s3_store.release_seats_cas(reservation["table_id"], reservation["seats_taken"]):
+    if s3_store.delete_reservation(reservation_id, date_str, reservation.get("login_id")):
+        if s3_store.release_seats_cas(reservation["table_id"], reservation["seats_taken"], reservation_id=reservation_id):
             return jsonify(success=True)
         else:
              logger.warning(f"預訂 {reservation_id} 已刪除, 但 CAS 釋放座位失敗")
@@ -373,6 +695,48 @@ def cancel():
     else:
         return jsonify(success=False, message="Failed to cancel reservation"), 500
 
+# ---------- (新) API：批次取消預約 (S3 DeleteObjects + 單次 CAS) ----------
+@app.post("/api/admin/cancel_batch")
+@require_admin_token # Admin 才能取消
+def cancel_batch():
+    payload = request.get_json(force=True)
+    reservation_ids = payload.get("reservation_ids")
+    if not isinstance(reservation_ids, list) or not reservation_ids:
+        return jsonify(success=False, message="reservation_ids required"), 400
+    if not all(isinstance(rid, str) for rid in reservation_ids):
+        return jsonify(success=False, message="reservation_ids must be strings"), 400
+    reservation_ids = list(dict.fromkeys(reservation_ids))
+
+    by_id = {r.get("id"): r for r in s3_store.get_all_reservations()}
+    dates = {rid: _reservation_date(by_id[rid]) for rid in reservation_ids if rid in by_id}
+    # 快取清單可能過期 (其他 worker 剛建立的預訂)：不在快取中的 id 與單筆取消一樣以日期索引查詢，並行送出
+    misses = [rid for rid in reservation_ids if rid not in by_id]
+    for rid, (reservation, date_str) in zip(misses, _io_pool.map(s3_store.get_reservation_with_date, misses)):
+        if reservation:
+            by_id[rid] = reservation
+            dates[rid] = date_str
+    not_found = [rid for rid in reservation_ids if rid not in by_id]
+    items = [(rid, dates[rid], by_id[rid].get("login_id")) for rid in reservation_ids if rid in by_id]
+    if not items:
+        return jsonify(success=False, message="Reservation not found", not_found=not_found), 404
+
+    deleted = s3_store.delete_reservations_batch(items)
+    if not deleted:
+        return jsonify(success=False, message="Failed to cancel reservations"), 500
+
+    # 同一張桌子的座位合併成一次 CAS 寫回；快取清單可能過期，
+    # 實際歸還的座位以 tables.json 預訂摘要中仍存在的預訂為準，不會重複釋放
+    seats_by_table = {}
+    for rid in deleted:
+        r = by_id[rid]
+        seats_by_table[r["table_id"]] = seats_by_table.get(r["table_id"], 0) + r["seats_taken"]
+    if not s3_store.release_seats_batch_cas(seats_by_table, reservation_ids=deleted):
+        logger.warning(f"批次取消 {len(deleted)} 筆預訂已刪除, 但 CAS 釋放座位失敗")
+        return jsonify(success=True, deleted=deleted, not_found=not_found,
+                       message="Reservations deleted, but seat release failed. Please resync.")
+    return jsonify(success=True, deleted=deleted, not_found=not_found)
+
+
 
 # ---------- (!!! 已優化 - CAS !!!) API：更新訂位資訊 ----------
 @app.post("/api/admin/update_reservation")
@@ -397,10 +761,13 @@ def update_reservation_details():
     if not new_login_id or not new_name:
         return jsonify(success=False, message="Fields cannot be empty"), 400
 
-    seat_diff = 0 
+    table_updated = False
+    login_claimed = False
+    committed = False
     table_id = None
     try:
-        reservation, date_str = _find_reservation_and_date(reservation_id)
+        # 連同 ETag 一起讀取，寫回時以條件寫入避免蓋掉同時進行的其他修改
+        reservation, date_str, etag = s3_store.get_reservation_versioned(reservation_id)
         if not reservation:
             return jsonify(success=False, message="Reservation not found"), 404
 
@@ -408,43 +775,46 @@ def update_reservation_details():
         current_seats = reservation.get("seats_taken")
         table_id = reservation.get("table_id") 
 
+        # 變更 login_id 時先以條件寫入佔用新 login_id (再動座位)，衝突時不必回滾座位
+        if current_login_id != new_login_id:
+            login_claimed = s3_store.claim_login_id(new_login_id, reservation_id)
+            if not login_claimed:
+                return jsonify(success=False, message=f"The new login_id '{new_login_id}' is already taken."), 409
+
+        current_name = reservation.get("employee_name")
         seat_diff = new_seats - current_seats
-        if seat_diff > 0:
-            if not s3_store.reserve_seats_cas(table_id, seat_diff):
+        # 座位增減與桌位預訂摘要 (姓名/座位數) 在同一次 CAS 中更新
+        if seat_diff != 0 or new_name != current_name:
+            if s3_store.update_table_reservation_cas(table_id, reservation_id, seat_diff, new_name, new_seats):
+                table_updated = True
+            elif seat_diff > 0:
                 return jsonify(success=False, message=f"Not enough seats on Table {table_id} (or CAS conflict)"), 409
-        elif seat_diff < 0:
-            if not s3_store.release_seats_cas(table_id, abs(seat_diff)):
-                 logger.warning(f"更新 {reservation_id} 時釋放座位失敗")
+            else:
+                logger.warning(f"更新 {reservation_id} 時調整桌位資料失敗")
 
-        if current_login_id != new_login_id:
-            if s3_store.check_login_id_exists(new_login_id):
-                if seat_diff > 0:
-                    s3_store.release_seats_cas(table_id, seat_diff) 
-                elif seat_diff < 0:
-                    s3_store.reserve_seats_cas(table_id, abs(seat_diff)) 
-                return jsonify(success=False, message=f"The new login_id '{new_login_id}' is already taken."), 409
-        
-        reservation["login_id"] = new_login_id
-        reservation["employee_name"] = new_name
-        reservation["seats_taken"] = new_seats
-        reservation["updated_at"] = datetime.now(TAIWAN_TZ).isoformat()
+        # 只送出變更的欄位（不直接修改快取中的 reservation dict）
+        updates = {
+            "login_id": new_login_id,
+            "employee_name": new_name,
+            "seats_taken": new_seats
+        }
 
-        if s3_store.update_reservation(reservation_id, reservation, date_str):
+        if s3_store.update_reservation(reservation_id, updates, date_str, current=reservation, etag=etag):
+            committed = True
             return jsonify(success=True, message="Reservation updated.")
         else:
-            if seat_diff > 0:
-                s3_store.release_seats_cas(table_id, seat_diff)
-            elif seat_diff < 0:
-                s3_store.reserve_seats_cas(table_id, abs(seat_diff))
+            if table_updated:
+                s3_store.update_table_reservation_cas(table_id, reservation_id, -seat_diff, current_name, current_seats)
             return jsonify(success=False, message="Failed to save update to S3."), 500
 
     except Exception as e:
         logger.error(f"[ERROR] 更新預訂失敗: {e}")
-        if seat_diff > 0 and table_id:
-            s3_store.release_seats_cas(table_id, seat_diff)
-        elif seat_diff < 0 and table_id:
-             s3_store.reserve_seats_cas(table_id, abs(seat_diff))
+        if table_updated:
+            s3_store.update_table_reservation_cas(table_id, reservation_id, -seat_diff, current_name, current_seats)
         return jsonify(success=False, message=str(e)), 500
+    finally:
+        if login_claimed and not committed:
+            s3_store.release_login_id(new_login_id)
 
 # ---------- API：資料重新同步 (!!! 已優化 - CAS !!!) ----------
 @app.post("/api/admin/resync")
@@ -452,28 +822,19 @@ def update_reservation_details():
 def admin_resync():
     try:
         logger.info("[INFO] 開始重新同步桌位資料...")
-        all_reservations = s3_store.get_all_reservations()
-        actual_seats_taken = {}
-        for r in all_reservations:
-            table_id_str = str(r.get("table_id"))
-            seats = r.get("seats_taken", 1) 
-            if table_id_str not in actual_seats_taken:
-                actual_seats_taken[table_id_str] = 0
-            actual_seats_taken[table_id_str] += seats
-
+        # 先讀 tables.json (含 ETag) 再從 S3 重新讀取全部預訂 (不用快取)：
+        # 讀取期間有新的預訂時 CAS 會失敗，不會以過期的預訂清單覆寫座位與摘要
         tables_data, etag = s3_store.get_tables_data_with_etag()
         if not tables_data:
             return jsonify(success=False, message="No tables data found to resync."), 500
-
-        updated_count = 0
-        for table_id_str, table in tables_data.items():
-            total_seats = table.get("total", 10) 
-            taken_seats = actual_seats_taken.get(table_id_str, 0) 
-            new_seats_left = total_seats - taken_seats
-            if table["seats_left"] != new_seats_left:
-                logger.info(f"[RESYNC] 桌號 {table_id_str}: 剩餘座位 {table['seats_left']}, 修正為 {new_seats_left}")
-                table["seats_left"] = new_seats_left
-                updated_count += 1
+        all_reservations = s3_store.get_all_reservations(fresh=True)
+        s3_store.rebuild_login_markers(reservations=all_reservations)
+
+        updated_count = _resync_tables(tables_data, all_reservations)
+        # (優化) 沒有任何修正時不必寫回 tables.json
+        if updated_count == 0:
+            logger.info("[INFO] 重新同步完成。沒有需要修正的桌子。")
+            return jsonify(success=True, message="Resync complete. 0 table(s) corrected.")
             
         try:
             s3_store.save_tables_data_cas(tables_data, etag)
@@ -498,30 +859,52 @@ def export_csv():
     # (新) 允許透過 query 篩選 table_id
     table_id = request.args.get("table_id", type=int)
 
-    out = io.StringIO()
-    writer = csv.writer(out)
-    writer.writerow(["id", "table_id", "seats_taken", "employee_name", "login_id", "created_at"])
-    
-    reservations = s3_store.get_all_reservations()
+    # S3Store 已依建立時間由舊到新排序，反向走訪即為由新到舊
+    reservations = reversed(s3_store.get_all_reservations())
 
     # (新) 如果有 table_id，則篩選
+    # (優化) 以產生器邊走訪邊篩選，串流時不再另外複製一份篩選後的清單
     if table_id:
-        reservations = [r for r in reservations if r.get("table_id") == table_id]
-        
-    reservations.sort(key=lambda x: x.get("created_at", ""), reverse=True)
-    
-    for r in reservations:
-        writer.writerow([
-            r.get("id", ""), r.get("table_id", ""), r.get("seats_taken", ""),
-            r.get("employee_name", ""), r.get("login_id", ""), r.get("created_at", "")
-        ])
-    mem = io.BytesIO(out.getvalue().encode("utf-8"))
-    mem.seek(0)
-    
+        reservations = (r for r in reservations if r.get("table_id") == table_id)
+
     # (新) 檔名
     filename = f"reservations_table_{table_id}.csv" if table_id else "reservations_all.csv"
-    
-    return send_file(mem, mimetype="text/csv", as_attachment=True, download_name=filename)
+
+    # (優化) 逐列產生 CSV 串流回應，不先在記憶體組出整份檔案 (StringIO + BytesIO 兩份複本)
+    return app.response_class(
+        _iter_csv_rows(reservations), mimetype="text/csv",
+        headers={"Content-Disposition": f"attachment; filename={filename}"}
+    )
+
+_CSV_CHUNK_ROWS = 500
+
+def _iter_csv_rows(reservations):
+    """每 _CSV_CHUNK_ROWS 列送出一個區塊：記憶體只保留一個區塊，也不會產生大量極小的寫出"""
+    # 只有匯出會用到 csv，延後到第一次匯出才載入
+    import csv, io
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+
+    def take():
+        chunk = buf.getvalue()
+        buf.seek(0)
+        buf.truncate(0)
+        return chunk
+
+    writer.writerow(["id", "table_id", "seats_taken", "employee_name", "login_id", "created_at"])
+    rows = (
+        (r.get("id", ""), r.get("table_id", ""), r.get("seats_taken", ""),
+         r.get("employee_name", ""), r.get("login_id", ""), r.get("created_at", ""))
+        for r in reservations
+    )
+    # (優化) 每個區塊以一次 writerows 寫入，逐列迴圈在 C 裡執行
+    while True:
+        chunk = list(islice(rows, _CSV_CHUNK_ROWS))
+        if not chunk:
+            break
+        writer.writerows(chunk)
+        yield take()
+    yield take()
 
 # ---------- (新) 速率限制的錯誤處理 ----------
 @app.errorhandler(429)
@@ -540,4 +923,6 @@ if __name__ == "__main__":
         print(f"[WARN] init_tables 已跳過: {e}")
     print(f"[INFO] Admin 驗證: {'啟用' if ENABLE_ADMIN_AUTH else '停用'}")
     port = int(os.getenv("PORT", 8000))
-    app.run(host="0.0.0.0", port=port, debug=False)
+    # 僅供本機開發；正式環境以 gunicorn -c gunicorn.conf.py "app:app" 啟動 (gthread 多 worker)
+    # threaded=True：開發伺服器也讓各請求的 S3 I/O 互相重疊，行為較接近正式環境
+    app.run(host="0.0.0.0", port=port, debug=False, threaded=True)
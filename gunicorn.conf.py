@@ -0,0 +1,45 @@
+# ======================================
+# gunicorn.conf.py - Gunicorn 設定
+# ======================================
+import multiprocessing
+import os
+
+bind = f":{os.environ.get('PORT', '8080')}"
+
+# (優化) 每個請求幾乎都在等 S3 I/O，改用 gthread：
+# 同一個 worker 內多條執行緒可重疊等待時間
+worker_class = "gthread"
+workers = int(os.environ.get('GUNICORN_WORKERS', multiprocessing.cpu_count() * 2 + 1))
+threads = int(os.environ.get('GUNICORN_THREADS', 8))
+
+# (優化) master 先載入 app 再 fork，worker 共用已 import 的模組 (copy-on-write)
+preload_app = True
+
+# (優化) worker 心跳檔放在 tmpfs；預設的 /tmp 在容器內可能是磁碟或 overlay，
+# 心跳的 fchmod 遇到 I/O 壅塞時會卡住 worker 而被誤判逾時
+worker_tmp_dir = "/dev/shm" if os.path.isdir("/dev/shm") else None
+
+
+def on_starting(server):
+    # (優化) 只在 master 啟動時初始化一次桌位資料，
+    # 避免每個 worker (或 import app 時) 都重複打 S3
+    from app import init_tables, s3_store
+    init_tables()
+    # idempotency/ 交給 S3 Lifecycle 過期刪除 (規則已存在時只多一次 GET)
+    s3_store.ensure_idempotency_lifecycle()
+
+
+def post_fork(server, worker):
+    # preload 時 master 已用過 S3 client (init_tables)，
+    # 每個 worker 重建自己的連線池，不共用 fork 前的 socket
+    from app import s3_store
+    s3_store.reset_connections()
+
+
+def post_worker_init(worker):
+    # (優化) 先打一次 HeadBucket 完成 TLS 握手，第一個使用者請求不必負擔建線成本
+    from app import s3_store
+    try:
+        s3_store.test_connection()
+    except Exception as e:
+        worker.log.warning(f"S3 預熱失敗: {e}")
@@ -10,16 +10,28 @@ class TableInventory(db.Model):
     name = db.Column(db.String(64), nullable=True)
     total = db.Column(db.Integer, nullable=False, default=10)
     seats_left = db.Column(db.Integer, nullable=False, default=10)
-    __table_args__ = (CheckConstraint('seats_left >= 0', name='ck_seats_non_negative'),)
+    __table_args__ = (
+        CheckConstraint('seats_left >= 0', name='ck_seats_non_negative'),
+        # 已滿的桌 (availability)；有 CHECK 約束，seats_left <= 0 即 seats_left = 0
+        db.Index("ix_tables_seats_left", seats_left, postgresql_where=(seats_left == 0)),
+    )
 
 class Reservation(db.Model):
     __tablename__ = "reservations"
     id = db.Column(db.String(36), primary_key=True, default=lambda: str(uuid.uuid4()))
-    table_id = db.Column(db.Integer, db.ForeignKey("tables.id"), nullable=False, index=True)
+    table_id = db.Column(db.Integer, db.ForeignKey("tables.id"), nullable=False)
     seats_taken = db.Column(db.Integer, nullable=False, default=1)
     employee_name = db.Column(db.String(128), nullable=False)
     login_id = db.Column(db.String(128), nullable=False)
     created_at = db.Column(db.DateTime(timezone=True), server_default=func.now())
+    # keyset 分頁 (created_at, id) 由新到舊
+    __table_args__ = (
+        db.Index("ix_res_created_id", created_at.desc(), id.desc()),
+        # 依桌篩選再依時間排序；最左欄也涵蓋原本單獨的 table_id 索引
+        db.Index("ix_res_table_created", table_id, created_at.desc()),
+        # login_id 以不分大小寫比對 (lower(login_id) = :l)，存在性檢查可直接命中索引
+        db.Index("ix_res_login_id_lower", func.lower(login_id)),
+    )
 
 class IdempotencyKey(db.Model):
     __tablename__ = "idempotency_keys"
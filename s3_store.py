@@ -1,14 +1,22 @@
 # ======================================
-# s3_store.py - v4.5 (最佳努力 CAS + 5秒快取 + 中文日誌)
+# s3_store.py - v4.6 (條件寫入 CAS + 5秒快取 + 中文日誌)
 # ======================================
 import boto3
-import json
+import gzip
+# (優化) S3 物件一律以 orjson 讀寫：直接產生/解析 UTF-8 bytes，且不再縮排 (物件約小一半)
+import orjson
 import os
 from datetime import datetime, timezone, timedelta
+from botocore.config import Config
 from botocore.exceptions import ClientError
 import logging
+import random
+import re
 import threading
 import time
+from urllib.parse import quote
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 
 # 設定日誌
 logging.basicConfig(level=logging.INFO)
@@ -17,171 +25,878 @@ logger = logging.getLogger(__name__)
 # 台灣時區 (UTC+8)
 TAIWAN_TZ = timezone(timedelta(hours=8))
 
+# (優化) 連線池大小需涵蓋 gthread 執行緒 (8) + 請求內並行 I/O (8) + 重建列表快取的並行讀取 (32)；
+# 重試改用 adaptive 模式
+# tcp_keepalive：閒置的池內連線不易被中途設備切斷，下次請求可直接重用而不必重新握手
+S3_CLIENT_CONFIG = Config(
+    max_pool_connections=64,
+    retries={"max_attempts": 3, "mode": "adaptive"},
+    tcp_keepalive=True,
+)
+
+# (優化) 同一程序內的所有 S3Store 共用一個 client (boto3 client 為 thread-safe)，
+# 不必各自建立 session 與連線池；fork 後由 reset_connections 重建
+_shared_client = None
+_shared_client_lock = threading.Lock()
+
+def _get_shared_client(rebuild=False):
+    global _shared_client
+    with _shared_client_lock:
+        if rebuild or _shared_client is None:
+            _shared_client = boto3.client('s3', config=S3_CLIENT_CONFIG)
+        return _shared_client
+
+# (優化) 會隨預訂數成長的彙總物件 (tables.json、每日彙總) 以 gzip 存放 (ContentEncoding=gzip)，
+# 傳輸量約為原本的 1/5；單筆預訂等小物件壓縮無益，維持原樣。讀取時依 ContentEncoding 判斷，
+# 未壓縮的舊物件照常可讀。mtime=0 讓相同內容產生相同 bytes (ETag 穩定)；
+# tables.json 每次預訂都要重寫，壓縮等級用 1 (重複性高的 JSON 壓縮率與 9 相差有限，CPU 少很多)
+GZIP_MIN_BYTES = 1024
+# tables.json 是舊版程式也會讀取的物件：舊版不會解壓縮，滾動更新期間寫入 gzip 會讓仍在服務的舊執行個體出錯。
+# 本版只讀取端支援 gzip，寫入預設維持未壓縮；所有執行個體都更新後再設 TABLES_JSON_GZIP=true 開啟
+# (每日彙總是新物件，舊版不會讀取，不受影響)
+TABLES_JSON_GZIP = os.environ.get('TABLES_JSON_GZIP', 'false').lower() == 'true'
+
+def _encode_aggregate(data, compress=True):
+    """回傳 (JSON bytes, 實際上傳的 body, put_object 額外參數)"""
+    raw = orjson.dumps(data)
+    if not compress or len(raw) < GZIP_MIN_BYTES:
+        return raw, raw, {}
+    return raw, gzip.compress(raw, compresslevel=1, mtime=0), {"ContentEncoding": "gzip"}
+
+def _read_body(resp):
+    body = resp['Body'].read()
+    if resp.get('ContentEncoding') == 'gzip':
+        return gzip.decompress(body)
+    return body
+
+# (優化) 日期字串重複性極高，正規化結果以 LRU 快取，免去每次 strptime
+# 常見格式 (YYYY-MM-DD 或 YYYY/MM/DD 開頭) 以正規式 + datetime() 驗證，比 strptime 快；其他格式照舊
+_DATE_RE = re.compile(r'(\d{4})[-/](\d{2})[-/](\d{2})')
+
+@lru_cache(maxsize=2048)
+def _normalize_date_cached(date_str):
+    ds = str(date_str).strip()
+    m = _DATE_RE.match(ds)
+    if m:
+        try:
+            datetime(int(m[1]), int(m[2]), int(m[3]))
+            return f"{m[1]}-{m[2]}-{m[3]}"
+        except ValueError:
+            return None
+    ds = ds.replace('/', '-')
+    if len(ds) >= 10:
+        ds = ds[:10]
+    try:
+        datetime.strptime(ds, '%Y-%m-%d')
+        return ds
+    except Exception:
+        return None
+
+# (優化) CAS 衝突的退避改用 decorrelated jitter：同時衝突的請求各自隨機等待，
+# 不會像固定的線性退避一樣在同一時間點再次相撞
+CAS_BACKOFF_BASE = 0.05
+CAS_BACKOFF_CAP = 1.0
+
+def _cas_backoff(prev_delay):
+    """等待一段 decorrelated jitter 時間；回傳本次等待秒數，供下一次計算"""
+    delay = random.uniform(CAS_BACKOFF_BASE, min(CAS_BACKOFF_CAP, prev_delay * 3))
+    time.sleep(delay)
+    return delay
+
 class S3Store:
+    VERSION = "4.6-cas-if-match"
+
     def __init__(self):
-        self.VERSION = "4.5-cas-best-effort"
         self.bucket_name = os.environ.get('S3_BUCKET_NAME', 'seat-reservation-data-2025')
-        self.s3_client = boto3.client('s3')
-        self.s3_resource = boto3.resource('s3')
-        self.bucket = self.s3_resource.Bucket(self.bucket_name)
+        self._bind_client(_get_shared_client())
 
         # get_all_reservations 記憶體快取（5 秒）
         self.all_reservations_cache = None
         self.all_reservations_expiry = 0.0
         self.all_reservations_lock = threading.Lock()
         self.CACHE_TTL_SECONDS = 5
+        # 快取建立時的預訂版本標記 ETag；到期時版本未變就延長，但最久沿用 CACHE_MAX_AGE_SECONDS
+        self.all_reservations_version = None
+        self.all_reservations_built = 0.0
+        self.CACHE_MAX_AGE_SECONDS = 60
+
+        # get_tables_data 記憶體快取（同樣 5 秒；本程序寫入 tables.json 時清除）
+        self.tables_cache = None
+        self.tables_expiry = 0.0
+        self.tables_lock = threading.Lock()
+        # 最近一次讀到/寫入的 tables.json (ETag 去引號, 原始 bytes, 共用的已解析 dict 或 None)，供條件 GET 使用
+        self.tables_raw = None
+
+        # /api/status 用的預訂摘要（跟隨 all_reservations 快取重建）
+        self.reservation_summary_cache = None  # (reservations list 物件, 摘要 dict)
+
+        # 已確認被佔用的 login_id（小寫 -> 到期時間）；只快取「存在」，不快取「不存在」
+        self.claimed_logins = {}
+
+        # 預訂 id -> 日期資料夾（建立後永不改變，可長期快取；刪除時移除）
+        self.slot_dates = {}
+        # 遍歷後仍找不到的預訂 id -> 到期時間（60 秒），避免錯誤 id 反覆觸發遍歷
+        self.slot_misses = {}
+
+        # 各日期已載入的預訂（日期 -> ({key: ETag}, [預訂...])）；列出的 ETag 完全相同才沿用，
+        # 因此任何寫入 (包含其他 worker) 只會讓該日期重新讀取，其他日期不受影響
+        self.date_chunks = {}
+
+        # 版本標記改在背景寫入（第一次用到時才建立執行緒，避免 fork 前就有執行緒）
+        self.version_marker_pool = None
+        self.version_marker_pending = False
+        self.version_marker_lock = threading.Lock()
+
+    def reset_connections(self):
+        """重建共用的 S3 client（fork 後呼叫，避免子程序沿用 master 的連線池）"""
+        self._bind_client(_get_shared_client(rebuild=True))
+        # master 的背景執行緒不會跟著 fork 過來
+        self.version_marker_pool = None
+        self.version_marker_pending = False
+
+    def _bind_client(self, client):
+        self.s3_client = client
+        # (優化) GetObject 找不到物件時拋出的具型例外：以 except 攔截，不必再比對錯誤碼字串
+        self.NoSuchKey = client.exceptions.NoSuchKey
 
     # -------------- 工具：清除快取 --------------
     def _clear_all_reservations_cache(self):
         logger.info("清除 'all_reservations' 快取…")
-        self.all_reservations_cache = None
         self.all_reservations_expiry = 0.0
+        self.all_reservations_cache = None
+
+    def _clear_tables_cache(self):
+        self.tables_expiry = 0.0
+        self.tables_cache = None
+
+    # -------------- (新) 預訂版本標記 --------------
+    # 任何預訂寫入後更新 index/reservations_version；列表快取到期時先 HEAD 這個標記，
+    # ETag 未變 (期間沒有任何程序寫入預訂) 就延長原快取，不必重新列出與讀取
+    _RESERVATIONS_VERSION_KEY = "index/reservations_version"
+
+    def _reservations_changed(self):
+        """
+        預訂寫入/刪除後呼叫：清除本程序的列表快取，並在背景更新版本標記。
+        (優化) 標記的 PUT 不在請求的關鍵路徑上；尚未送出的標記更新會合併成一次，
+        尖峰時不會每筆預訂都多一次寫入。
+        """
+        self._clear_all_reservations_cache()
+        with self.version_marker_lock:
+            if self.version_marker_pending:
+                return
+            self.version_marker_pending = True
+            if self.version_marker_pool is None:
+                self.version_marker_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="s3-version")
+            pool = self.version_marker_pool
+        try:
+            pool.submit(self._put_reservations_version)
+        except RuntimeError:
+            # 直譯器關閉中無法再排程，改為直接寫入
+            self._put_reservations_version()
+
+    def _put_reservations_version(self):
+        with self.version_marker_lock:
+            # 之後的寫入會再排一次，確保標記一定晚於最後一筆寫入
+            self.version_marker_pending = False
+        try:
+            self.s3_client.put_object(
+                Bucket=self.bucket_name,
+                Key=self._RESERVATIONS_VERSION_KEY,
+                Body=os.urandom(16).hex(),
+                ContentType='text/plain'
+            )
+        except ClientError as e:
+            # 其他程序最久在 CACHE_MAX_AGE_SECONDS 後仍會重建
+            logger.warning(f"更新預訂版本標記失敗: {e}")
+
+    def _head_reservations_version(self):
+        """回傳版本標記的 ETag；不存在或讀取失敗時回傳 None (視為需要重建)"""
+        try:
+            return self.s3_client.head_object(Bucket=self.bucket_name, Key=self._RESERVATIONS_VERSION_KEY)["ETag"]
+        except ClientError as e:
+            if e.response.get("Error", {}).get("Code") not in ("404", "NoSuchKey"):
+                logger.warning(f"讀取預訂版本標記失敗: {e}")
+            return None
+
+    def _write_through_tables_cache(self, tables_data, body, resp):
+        """本程序剛寫入 tables.json：直接以寫入內容更新快取，下一次讀取不必再 GET"""
+        self.tables_raw = (resp['ETag'].strip('"'), body, tables_data)
+        with self.tables_lock:
+            self.tables_cache = tables_data
+            self.tables_expiry = time.monotonic() + self.CACHE_TTL_SECONDS
 
     # -------------- 工具：日期處理 --------------
     def _normalize_date(self, date_str):
         if not date_str:
             return None
-        ds = str(date_str).strip().replace('/', '-')
-        if len(ds) >= 10:
-            ds = ds[:10]
+        return _normalize_date_cached(date_str)
+
+    def _reservation_key(self, slot_id, ds):
+        """預約檔位置；ds 必須是已正規化的 YYYY-MM-DD (不再重複驗證)"""
+        return f"reservations/{ds}/{slot_id}.json"
+
+    # -------------- 工具：id -> 日期 索引 --------------
+    # 每筆預訂另存一個極小的索引物件 index/slots/{slot_id}.json（內容為日期），
+    # 查日期只需一次 GET，不必遍歷整個 reservations/ (也沒有共用索引檔的讀改寫競爭)
+    def _slot_index_key(self, slot_id):
+        return f"index/slots/{slot_id}.json"
+
+    # (優化) 預訂的日期在建立後不會改變：本程序寫入或讀到過的對應直接記在記憶體，
+    # 取消/更新時不必再 GET 索引物件
+    _SLOT_DATES_MAX = 100000
+
+    _SLOT_MISS_SECONDS = 60
+
+    def _remember_slot_date(self, slot_id, ds):
+        if len(self.slot_dates) >= self._SLOT_DATES_MAX:
+            self.slot_dates.clear()
+        self.slot_dates[slot_id] = ds
+        self.slot_misses.pop(slot_id, None)
+
+    def get_slot_date(self, slot_id):
+        """從索引物件取得預訂所在日期；沒有索引時回傳 None（不遍歷）"""
+        ds = self.slot_dates.get(slot_id)
+        if ds:
+            return ds
         try:
-            datetime.strptime(ds, '%Y-%m-%d')
+            resp = self.s3_client.get_object(Bucket=self.bucket_name, Key=self._slot_index_key(slot_id))
+            ds = self._normalize_date(orjson.loads(resp['Body'].read()).get('date'))
+            if ds:
+                self._remember_slot_date(slot_id, ds)
             return ds
-        except Exception:
+        except self.NoSuchKey:
+            return None
+        except ClientError as e:
+            logger.error(f"讀取日期索引失敗: {e}")
             return None
 
-    def _find_date_by_slot(self, slot_id):
+    def put_slot_index(self, slot_id, ds):
+        """寫入 slot_id → 日期索引；失敗只記錄警告 (查詢時會退回遍歷並補寫)"""
         try:
-            paginator = self.s3_client.get_paginator('list_objects_v2')
-            for page in paginator.paginate(Bucket=self.bucket_name, Prefix='reservations/'):
-                for obj in page.get('Contents', []):
-                    key = obj['Key']
-                    if key.endswith(f'/{slot_id}.json'):
-                        parts = key.split('/')
-                        if len(parts) >= 3:
-                            return parts[1]
+            self.s3_client.put_object(
+                Bucket=self.bucket_name,
+                Key=self._slot_index_key(slot_id),
+                Body=orjson.dumps({"date": ds}),
+                ContentType='application/json'
+            )
         except ClientError as e:
-            logger.error(f"遍歷查找 slot 所在日期失敗: {e}")
+            logger.warning(f"寫入日期索引失敗 slot_id={slot_id}: {e}")
+
+    def _find_date_by_slot(self, slot_id, near_date=None):
+        ds = self.get_slot_date(slot_id)
+        if ds:
+            return ds
+        # (新) 60 秒內才遍歷過仍找不到：直接回 None
+        expiry = self.slot_misses.get(slot_id)
+        if expiry is not None and expiry > time.monotonic():
+            return None
+        # 舊資料尚無索引：退回遍歷，找到後補寫索引
+        ds = self._scan_date_by_slot(slot_id, near_date)
+        if ds:
+            self.put_slot_index(slot_id, ds)
+        else:
+            if len(self.slot_misses) >= self._SLOT_DATES_MAX:
+                self.slot_misses.clear()
+            self.slot_misses[slot_id] = time.monotonic() + self._SLOT_MISS_SECONDS
+        return ds
+
+    def _scan_date_by_slot(self, slot_id, near_date=None):
+        # (優化) 先以 Delimiter 列出日期資料夾，再由新到舊逐日 HEAD 該 slot 的物件；
+        # 近期預訂通常在最新的日期，成本為 O(日期數) 次 HEAD，而非逐頁列出全部物件。
+        # 呼叫端給的日期不對時，通常只差一天：near_date 的前後一天優先檢查
+        dates = sorted(self.list_reservation_dates(), reverse=True)
+        if near_date:
+            day = datetime.strptime(near_date, '%Y-%m-%d')
+            near = {(day + timedelta(days=d)).strftime('%Y-%m-%d') for d in (-1, 1)}
+            dates.sort(key=lambda ds: ds not in near)
+        for ds in dates:
+            try:
+                self.s3_client.head_object(Bucket=self.bucket_name, Key=self._reservation_key(slot_id, ds))
+                return ds
+            except ClientError as e:
+                if e.response['Error']['Code'] not in ('404', 'NoSuchKey', 'NotFound'):
+                    logger.error(f"查找 slot 所在日期失敗 date={ds}: {e}")
+                    return None
         return None
 
+    # -------------- 工具：login_id 標記物件 --------------
+    # 每個已預約的 login_id 對應一個標記物件 index/login_ids/{login_id}（小寫、URL 編碼），
+    # 防重複檢查只需一次 HEAD，不必列出並掃描全部預訂
+    def _login_marker_key(self, login_id):
+        return f"index/login_ids/{quote(str(login_id).lower(), safe='')}"
+
+    # 同一 login_id 重複嘗試時直接回答「已存在」，免去 S3 請求。
+    # 刻意不做「不存在」的短路：其他 worker / 執行個體的寫入本程序看不到，
+    # 負向結果無法保證正確，仍需以條件寫入為準
+    def _remember_login(self, login_id):
+        self.claimed_logins[str(login_id).lower()] = time.monotonic() + self.CACHE_TTL_SECONDS
+
+    def _forget_login(self, login_id):
+        self.claimed_logins.pop(str(login_id).lower(), None)
+
+    def claim_login_id(self, login_id, slot_id):
+        """
+        以條件寫入 (IfNoneMatch='*') 建立 login_id 標記來佔用 login_id；已被佔用時回傳 False。
+        與先 HEAD 再寫入不同，同時送出的兩個請求只有一個會成功。其他 S3 錯誤照常拋出。
+        """
+        expiry = self.claimed_logins.get(str(login_id).lower())
+        if expiry is not None and expiry > time.monotonic():
+            return False
+        try:
+            self.s3_client.put_object(
+                Bucket=self.bucket_name,
+                Key=self._login_marker_key(login_id),
+                Body=orjson.dumps({"reservation_id": slot_id}),
+                ContentType='application/json',
+                IfNoneMatch='*'
+            )
+            self._remember_login(login_id)
+            return True
+        except ClientError as e:
+            code = e.response['Error']['Code']
+            if code == 'PreconditionFailed':
+                self._remember_login(login_id)
+                return False
+            if code == 'ConditionalRequestConflict':
+                # 另一個對同一 key 的條件寫入正在進行
+                return False
+            raise
+
+    def release_login_id(self, login_id):
+        """釋放 claim_login_id 佔用但最終未完成預訂的 login_id"""
+        self._delete_login_marker(login_id)
+
+    def _put_login_marker(self, login_id, slot_id):
+        """寫入 login_id 標記；已存在時保留原標記"""
+        try:
+            self.claim_login_id(login_id, slot_id)
+        except ClientError as e:
+            logger.warning(f"寫入 login_id 標記失敗 login_id={login_id}: {e}")
+
+    def _delete_login_marker(self, login_id):
+        self._forget_login(login_id)
+        try:
+            self.s3_client.delete_object(Bucket=self.bucket_name, Key=self._login_marker_key(login_id))
+        except ClientError as e:
+            logger.warning(f"刪除 login_id 標記失敗 login_id={login_id}: {e}")
+
+    def rebuild_login_markers(self, max_workers=16, reservations=None):
+        """
+        依現有預訂同步 login_id 標記：補寫缺少的標記（舊資料遷移用），
+        並移除沒有對應預訂的孤兒標記；回傳補寫筆數。
+        reservations 為呼叫端剛重新讀取的預訂清單；未提供時直接從 S3 重新讀取
+        """
+        if reservations is None:
+            reservations = self.get_all_reservations(fresh=True)
+        pending = {}
+        for r in reservations:
+            login_id = r.get('login_id')
+            if login_id:
+                pending.setdefault(str(login_id).lower(), (login_id, r.get('id')))
+        self._prune_login_markers({self._login_marker_key(lid) for lid, _ in pending.values()})
+        if not pending:
+            return 0
+
+        def put(item):
+            # (優化) 條件寫入本身就不會覆蓋既有標記，不必先 HEAD 檢查
+            try:
+                return self.claim_login_id(*item)
+            except ClientError as e:
+                logger.warning(f"寫入 login_id 標記失敗 login_id={item[0]}: {e}")
+                return False
+
+        # (優化) 每個標記各一個 PUT，彼此獨立，並行送出
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(pending))) as ex:
+            count = sum(ex.map(put, pending.values()))
+        if count:
+            logger.info(f"已補寫 {count} 個 login_id 標記")
+        return count
+
+    # 預訂流程中途失敗且釋放標記的 DELETE 也失敗 (或 worker 被中止) 時，標記會留下而沒有預訂，
+    # 該 login_id 會一直被擋；同步時刪除這類孤兒標記。
+    # 進行中的預訂先佔用標記、最後才寫入預訂，因此只刪除超過寬限時間的標記
+    LOGIN_MARKER_GRACE_SECONDS = 600
+
+    def _prune_login_markers(self, live_keys):
+        """刪除不在 live_keys 內且超過寬限時間的 login_id 標記；回傳刪除筆數"""
+        cutoff = datetime.now(timezone.utc) - timedelta(seconds=self.LOGIN_MARKER_GRACE_SECONDS)
+        orphans = []
+        try:
+            paginator = self.s3_client.get_paginator('list_objects_v2')
+            for page in paginator.paginate(Bucket=self.bucket_name, Prefix='index/login_ids/'):
+                for obj in page.get('Contents', ()):
+                    if obj['Key'] not in live_keys and obj['LastModified'] < cutoff:
+                        orphans.append(obj['Key'])
+            for i in range(0, len(orphans), 1000):
+                resp = self.s3_client.delete_objects(
+                    Bucket=self.bucket_name,
+                    Delete={"Objects": [{"Key": k} for k in orphans[i:i + 1000]], "Quiet": True}
+                )
+                for err in resp.get("Errors", []):
+                    logger.warning(f"刪除孤兒 login_id 標記失敗: {err.get('Key')} ({err.get('Code')})")
+        except ClientError as e:
+            logger.warning(f"清除孤兒 login_id 標記失敗: {e}")
+            return 0
+        if orphans:
+            # 本程序記住的「已佔用」可能正是這些標記
+            self.claimed_logins.clear()
+            logger.info(f"已移除 {len(orphans)} 個孤兒 login_id 標記")
+        return len(orphans)
+
     # -------------- 單筆讀寫（預約檔） --------------
-    def save_reservation(self, slot_id, reservation_data, date_str=None):
-        """儲存預訂資料到 S3（儲存後清除 all_reservations 快取）"""
+    def save_reservation(self, slot_id, reservation_data, date_str=None, write_login_marker=True,
+                         write_slot_index=True, if_match=None):
+        """
+        儲存預訂資料到 S3（儲存後清除 all_reservations 快取）。
+        呼叫端已用 claim_login_id 佔用 login_id 時傳 write_login_marker=False；
+        已自行 (並行) 寫入日期索引時傳 write_slot_index=False。
+        if_match 為讀取時的 ETag 時以條件寫入，物件已被改動則拋 ClientError(PreconditionFailed)。
+        """
         try:
-            reservation_data['created_at'] = reservation_data.get('created_at', datetime.now(TAIWAN_TZ).isoformat())
-            reservation_data['updated_at'] = datetime.now(TAIWAN_TZ).isoformat()
+            now_iso = datetime.now(TAIWAN_TZ).isoformat()
+            reservation_data.setdefault('created_at', now_iso)
+            reservation_data['updated_at'] = now_iso
 
-            ds = self._normalize_date(date_str) or self._find_date_by_slot(slot_id) \
-                 or datetime.now(TAIWAN_TZ).strftime('%Y-%m-%d')
-            key = f"reservations/{ds}/{slot_id}.json"
+            ds = self._normalize_date(date_str)
+            indexed = False
+            if not ds:
+                ds = self._find_date_by_slot(slot_id)
+                indexed = ds is not None
+            ds = ds or now_iso[:10]
+            key = self._reservation_key(slot_id, ds)
+            # 底線開頭的欄位僅供記憶體快取使用，不寫回 S3
+            body = {k: v for k, v in reservation_data.items() if not k.startswith('_')}
 
+            condition = {"IfMatch": f'"{if_match}"'} if if_match else {}
             self.s3_client.put_object(
                 Bucket=self.bucket_name,
                 Key=key,
-                Body=json.dumps(reservation_data, ensure_ascii=False, indent=2),
-                ContentType='application/json'
+                Body=orjson.dumps(body),
+                ContentType='application/json',
+                **condition
             )
             logger.info(f"預訂資料已儲存至 S3: {key}")
-            self._clear_all_reservations_cache()
+            self._remember_slot_date(slot_id, ds)
+            if write_slot_index and not indexed:
+                self.put_slot_index(slot_id, ds)
+            if write_login_marker and body.get('login_id'):
+                self._put_login_marker(body['login_id'], slot_id)
+            self._reservations_changed()
             return True
         except ClientError as e:
+            if if_match and e.response['Error']['Code'] in ('PreconditionFailed', 'ConditionalRequestConflict'):
+                raise
             logger.error(f"儲存預訂資料失敗: {e}")
             return False
 
-    def get_reservation(self, slot_id, date_str=None):
-        """讀取單一預訂資料；支援 date_str 為 None（自動尋找）"""
+    def get_reservation_with_date(self, slot_id):
+        """以 id 取得預訂與其所在日期（索引查日期 + 一次 GET）；找不到時回傳 (None, None)"""
+        data, ds, _ = self.get_reservation_versioned(slot_id)
+        return data, ds
+
+    def get_reservation_versioned(self, slot_id, date_str=None):
+        """
+        讀取預訂，回傳 (內容, 日期, ETag 去引號)；找不到時回傳 (None, None, None)。
+        date_str 不對 (或未提供) 時改由日期索引/遍歷找出實際日期
+        """
         ds = self._normalize_date(date_str)
         if ds:
-            key = f"reservations/{ds}/{slot_id}.json"
-            try:
-                resp = self.s3_client.get_object(Bucket=self.bucket_name, Key=key)
-                return json.loads(resp['Body'].read().decode('utf-8'))
-            except ClientError as e:
-                if e.response['Error']['Code'] != 'NoSuchKey':
-                    logger.error(f"讀取預訂資料失敗: {e}")
-
-        real_ds = self._find_date_by_slot(slot_id)
-        if real_ds:
-            key = f"reservations/{real_ds}/{slot_id}.json"
-            try:
-                resp = self.s3_client.get_object(Bucket=self.bucket_name, Key=key)
-                return json.loads(resp['Body'].read().decode('utf-8'))
-            except ClientError as e:
-                logger.error(f"讀取預訂資料失敗(跨日期): {e}")
+            data, etag = self._get_reservation_object(slot_id, ds)
+            if data is not None:
+                return data, ds, etag
+        real_ds = self._find_date_by_slot(slot_id, near_date=ds)
+        if real_ds and real_ds != ds:
+            data, etag = self._get_reservation_object(slot_id, real_ds)
+            if data is not None:
+                return data, real_ds, etag
+        return None, None, None
 
-        return None
+    def _get_reservation_object(self, slot_id, ds):
+        try:
+            resp = self.s3_client.get_object(Bucket=self.bucket_name, Key=self._reservation_key(slot_id, ds))
+            return orjson.loads(resp['Body'].read()), resp['ETag'].strip('"')
+        except self.NoSuchKey:
+            return None, None
+        except ClientError as e:
+            logger.error(f"讀取預訂資料失敗: {e}")
+            return None, None
 
-    def delete_reservation(self, slot_id, date_str=None):
-        """刪除單一預訂資料；刪除後清除 all_reservations 快取"""
+    def delete_reservation(self, slot_id, date_str=None, login_id=None):
+        """刪除單一預訂資料（連同索引與 login_id 標記）；刪除後清除 all_reservations 快取"""
         try:
             ds = self._normalize_date(date_str) or self._find_date_by_slot(slot_id)
             if not ds:
                 logger.warning(f"刪除失敗：找不到日期資料夾 slot_id={slot_id}")
                 return False
 
-            key = f"reservations/{ds}/{slot_id}.json"
-            self.s3_client.delete_object(Bucket=self.bucket_name, Key=key)
+            key = self._reservation_key(slot_id, ds)
+            objects = [{"Key": key}, {"Key": self._slot_index_key(slot_id)}]
+            if login_id:
+                objects.append({"Key": self._login_marker_key(login_id)})
+                self._forget_login(login_id)
+            self.slot_dates.pop(slot_id, None)
+            resp = self.s3_client.delete_objects(
+                Bucket=self.bucket_name,
+                Delete={"Objects": objects, "Quiet": True}
+            )
+            # Quiet 模式下個別物件刪除失敗不會拋錯，只會列在 Errors
+            failed = set()
+            for err in resp.get("Errors", []):
+                failed.add(err.get("Key"))
+                logger.error(f"刪除失敗: {err.get('Key')} ({err.get('Code')})")
+            if key in failed:
+                return False
             logger.info(f"預訂資料已刪除: {key}")
-            self._clear_all_reservations_cache()
+            self._reservations_changed()
             return True
         except ClientError as e:
             logger.error(f"刪除預訂資料失敗: {e}")
             return False
 
-    def update_reservation(self, slot_id, updated_data, date_str=None):
-        """更新預訂資料；更新後清除 all_reservations 快取"""
+    def delete_reservations_batch(self, items):
+        """
+        批次刪除多筆預訂資料（S3 DeleteObjects，每次最多 1000 筆）。
+        items 為 (slot_id, date_str, login_id) 清單；回傳成功刪除的 slot_id 清單。
+        """
+        items = [(slot_id, self._normalize_date(date_str), login_id) for slot_id, date_str, login_id in items]
+        # (優化) 沒帶日期的預訂同時查詢日期索引，不必逐筆一次來回
+        missing = [slot_id for slot_id, ds, _ in items if not ds]
+        found = {}
+        if missing:
+            with ThreadPoolExecutor(max_workers=min(16, len(missing))) as ex:
+                found = dict(zip(missing, ex.map(self._find_date_by_slot, missing)))
+
+        key_to_slot = {}
+        extra_keys = {}
+        for slot_id, ds, login_id in items:
+            ds = ds or found.get(slot_id)
+            if not ds:
+                logger.warning(f"批次刪除略過：找不到日期資料夾 slot_id={slot_id}")
+                continue
+            key = self._reservation_key(slot_id, ds)
+            key_to_slot[key] = slot_id
+            extra_keys[key] = [self._slot_index_key(slot_id)]
+            self.slot_dates.pop(slot_id, None)
+            if login_id:
+                extra_keys[key].append(self._login_marker_key(login_id))
+                self._forget_login(login_id)
+
+        # 日期索引與 login_id 標記一起放進同一批刪除
+        deleted = []
+        keys = []
+        for key in key_to_slot:
+            keys.append(key)
+            keys.extend(extra_keys[key])
         try:
-            existing = self.get_reservation(slot_id, date_str)
-            if existing is None:
-                logger.warning(f"預訂資料不存在，無法更新: {slot_id}")
-                return False
+            for i in range(0, len(keys), 1000):
+                chunk = keys[i:i + 1000]
+                resp = self.s3_client.delete_objects(
+                    Bucket=self.bucket_name,
+                    Delete={"Objects": [{"Key": k} for k in chunk], "Quiet": True}
+                )
+                failed = set()
+                for err in resp.get("Errors", []):
+                    failed.add(err.get("Key"))
+                    logger.error(f"批次刪除失敗: {err.get('Key')} ({err.get('Code')})")
+                deleted.extend(key_to_slot[k] for k in chunk if k in key_to_slot and k not in failed)
+        except ClientError as e:
+            logger.error(f"批次刪除預訂資料失敗: {e}")
+
+        if deleted:
+            logger.info(f"批次刪除 {len(deleted)} 筆預訂資料")
+            self._reservations_changed()
+        return deleted
+
+    def update_reservation(self, slot_id, updated_data, date_str=None, current=None, etag=None, retries=3):
+        """
+        更新預訂資料；更新後清除 all_reservations 快取。
+        以條件寫入 (IfMatch=讀取時的 ETag) 寫回：期間有其他更新時重新讀取、合併後再試，不會蓋掉別人的修改。
+        (優化) 呼叫端剛讀過這筆預訂時可傳入 current 與其 etag，省去再 GET 一次 (不會修改 current)
+        """
+        try:
+            for i in range(retries):
+                if current is not None and etag:
+                    existing, ds = dict(current), self._normalize_date(date_str)
+                else:
+                    existing, ds, etag = self.get_reservation_versioned(slot_id, date_str)
+                    if existing is None:
+                        logger.warning(f"預訂資料不存在，無法更新: {slot_id}")
+                        return False
+                current = None
 
-            existing.update(updated_data)
-            existing['updated_at'] = datetime.now(TAIWAN_TZ).isoformat()
-            return self.save_reservation(slot_id, existing, date_str)
+                old_login = existing.get('login_id')
+                existing.update(updated_data)
+                # updated_at 由 save_reservation 統一寫入
+                try:
+                    ok = self.save_reservation(slot_id, existing, ds, if_match=etag)
+                except ClientError:
+                    logger.warning(f"預訂更新衝突 (Attempt {i+1}/{retries})，重新讀取後再試: {slot_id}")
+                    date_str, etag = ds, None
+                    continue
+                # login_id 變更：save_reservation 已寫入新標記，移除舊標記
+                if ok and old_login and str(old_login).lower() != str(existing.get('login_id') or '').lower():
+                    self._delete_login_marker(old_login)
+                return ok
+            logger.warning(f"update_reservation 重試耗盡: {slot_id}")
+            return False
         except Exception as e:
             logger.error(f"更新預訂資料失敗: {e}")
             return False
 
     # -------------- 列表查詢（含 5 秒快取 + Single-Flight） --------------
-    def get_all_reservations(self):
+    def get_all_reservations(self, fresh=False):
         """
         取得所有預訂資料（昂貴 S3 遍歷 + 讀檔），加入 5 秒記憶體快取與鎖避免併發重複打 S3。
+        回傳的 list 已依 (created_at, id) 由舊到新排序，且為共用快取，呼叫端不可修改。
+        fresh=True 時（重新同步等以結果覆寫狀態的呼叫端）一律重新從 S3 讀取：
+        不使用 TTL 快取、不回傳重建中的舊快取、也不因版本標記未變而沿用；讀取失敗時拋出 ClientError。
         """
+        if fresh:
+            with self.all_reservations_lock:
+                return self._rebuild_all_reservations(self._head_reservations_version(), time.monotonic())
         now = time.monotonic()
-        if self.all_reservations_expiry > now:
+        # 先把快取取到區域變數再檢查到期時間，避免與清除快取交錯時讀到 None
+        cache = self.all_reservations_cache
+        if cache is not None and self.all_reservations_expiry > now:
             logger.info("從 'all_reservations' 快取提供資料")
-            return self.all_reservations_cache
+            return cache
 
-        with self.all_reservations_lock:
-            if self.all_reservations_expiry > now:
+        # (優化) 已有其他執行緒在重建時，有舊快取就先回舊的，不必排隊等整個 S3 讀取；
+        # 本程序寫入後快取已清空 (None)，此時仍會等待，確保讀得到自己的寫入
+        if not self.all_reservations_lock.acquire(blocking=cache is None):
+            logger.info("快取重建中，先提供舊的 'all_reservations' 快取")
+            return cache
+        try:
+            cache = self.all_reservations_cache
+            if cache is not None and self.all_reservations_expiry > now:
                 logger.info("從 'all_reservations' 快取提供資料 (double-check)")
-                return self.all_reservations_cache
+                return cache
 
-            logger.warning("快取失效！正在執行 S3 'get_all_reservations'…")
-            reservations = []
-            try:
-                paginator = self.s3_client.get_paginator('list_objects_v2')
-                pages = paginator.paginate(Bucket=self.bucket_name, Prefix='reservations/')
-                for page in pages:
-                    for obj in page.get('Contents', []):
-                        key = obj['Key']
-                        if not key.endswith('.json'):
-                            continue
-                        try:
-                            obj_resp = self.s3_client.get_object(Bucket=self.bucket_name, Key=key)
-                            data = json.loads(obj_resp['Body'].read().decode('utf-8'))
-                            reservations.append(data)
-                        except Exception as e:
-                            logger.warning(f"無法讀取預約檔案 {key}: {e}")
-
-                self.all_reservations_cache = reservations
+            # (優化) 先確認版本標記：沒有任何寫入時只需這一次 HEAD
+            # (必須在列出之前讀取：列出期間的寫入會讓下次檢查看到新版本)
+            version = self._head_reservations_version()
+            cached = self.all_reservations_cache
+            if (cached is not None and version is not None and version == self.all_reservations_version
+                    and now - self.all_reservations_built < self.CACHE_MAX_AGE_SECONDS):
+                logger.info("預訂版本未變，延長 'all_reservations' 快取")
                 self.all_reservations_expiry = now + self.CACHE_TTL_SECONDS
-                logger.warning(f"S3 'get_all_reservations' 完成，快取 {len(reservations)} 筆")
-                return reservations
+                return cached
+
+            try:
+                return self._rebuild_all_reservations(version, now)
             except ClientError as e:
                 logger.error(f"獲取所有預約失敗: {e}")
                 return []
+        finally:
+            self.all_reservations_lock.release()
+
+    def _rebuild_all_reservations(self, version, now):
+        """從 S3 重建 all_reservations 快取（呼叫端須持有 all_reservations_lock）；S3 錯誤照常拋出"""
+        logger.warning("快取失效！正在執行 S3 'get_all_reservations'…")
+        # (優化) 列出一次 (附 ETag)，再以每日彙總讀取：每個日期一次 GET，
+        # 只有彙總缺少或已過期的預約檔才個別 GET
+        reservations, dates = self._load_from_date_rollups(['reservations/'], max_workers=32)
+        dates = set(dates)
+        for ds in [ds for ds in self.date_chunks if ds not in dates]:
+            self.date_chunks.pop(ds, None)
+
+        # 建立快取時排序一次，列表/匯出不必每個請求重排
+        reservations.sort(key=self._reservation_order_key)
+        self.all_reservations_cache = reservations
+        self.all_reservations_expiry = now + self.CACHE_TTL_SECONDS
+        self.all_reservations_version = version
+        self.all_reservations_built = now
+        logger.warning(f"S3 'get_all_reservations' 完成，快取 {len(reservations)} 筆")
+        return reservations
+
+    def get_reservation_summary(self):
+        """
+        回傳 {table_id 字串: [{"name", "seats"}, ...]}，只保留座位狀態需要的欄位。
+        all_reservations 快取期間回傳同一個 dict（呼叫端不可修改），快取更新時才重建。
+        """
+        reservations = self.get_all_reservations()
+        cached = self.reservation_summary_cache
+        if cached is not None and cached[0] is reservations:
+            return cached[1]
+        summary = {}
+        for r in reservations:
+            summary.setdefault(r['_tid_str'], []).append(
+                {"name": r.get("employee_name", "Unknown"), "seats": r.get("seats_taken", 1)}
+            )
+        self.reservation_summary_cache = (reservations, summary)
+        return summary
+
+    # -------------- 依日期範圍查詢（只列需要的日期資料夾） --------------
+    def list_reservation_dates(self):
+        """列出 reservations/ 底下的所有日期資料夾（只取 CommonPrefixes，不列出物件）"""
+        dates = []
+        try:
+            paginator = self.s3_client.get_paginator('list_objects_v2')
+            for page in paginator.paginate(Bucket=self.bucket_name, Prefix='reservations/', Delimiter='/'):
+                for cp in page.get('CommonPrefixes', []):
+                    ds = cp['Prefix'][len('reservations/'):-1]
+                    if self._normalize_date(ds) == ds:
+                        dates.append(ds)
+        except ClientError as e:
+            logger.error(f"列出預約日期失敗: {e}")
+        return dates
+
+    @staticmethod
+    def _reservation_order_key(reservation):
+        return (reservation.get('created_at', ''), reservation.get('id', ''))
+
+    def get_reservations_for_dates(self, dates):
+        """讀取指定日期的所有預訂資料（每個日期一個 prefix，物件以執行緒池並行 GET）；依 (created_at, id) 由舊到新排序"""
+        wanted = {self._normalize_date(d) for d in dates} - {None}
+        # (優化) 全部預訂的快取仍有效時直接從中篩選 (已排序)，不再逐一 GET 各日期的檔案
+        cache = self.all_reservations_cache
+        if cache is not None and self.all_reservations_expiry > time.monotonic():
+            return [r for r in cache if (r.get('created_at') or '')[:10] in wanted]
+        try:
+            reservations, _ = self._load_from_date_rollups([f'reservations/{ds}/' for ds in sorted(wanted)])
+        except ClientError as e:
+            logger.error(f"依日期獲取預約失敗: {e}")
+            return []
+        reservations.sort(key=self._reservation_order_key)
+        return reservations
+
+    def count_reservations(self, dates=None):
+        """
+        只計算預訂筆數：快取有效時直接取長度，否則只列出 key 計數（不讀取物件內容）。
+        dates 為 None 時計算全部日期。
+        """
+        cache = self.all_reservations_cache
+        if dates is None and cache is not None and self.all_reservations_expiry > time.monotonic():
+            return len(cache)
+        if dates is None:
+            prefixes = ['reservations/']
+        else:
+            prefixes = [f'reservations/{ds}/' for ds in sorted({self._normalize_date(d) for d in dates} - {None})]
+        total = 0
+        try:
+            paginator = self.s3_client.get_paginator('list_objects_v2')
+            for prefix in prefixes:
+                for page in paginator.paginate(Bucket=self.bucket_name, Prefix=prefix):
+                    total += sum(1 for obj in page.get('Contents', ()) if obj['Key'][-5:] == '.json')
+        except ClientError as e:
+            logger.error(f"計算預約筆數失敗: {e}")
+        return total
+
+    # -------------- (新) 每日預訂彙總 --------------
+    # index/dates/{date}.json 把該日所有預約檔的內容連同其 ETag 存成一個物件：
+    #   {"reservations/{date}/{id}.json": {"etag": ..., "data": {...}}, ...}
+    # 讀取時以列出 reservations/ 取得的 (key, ETag) 為準：ETag 相符的直接用彙總內容，
+    # 只有新增/變更的預約檔才個別 GET，之後再以條件寫入更新彙總。
+    # 彙總只是讀取端的衍生資料，寫入預約時不必等它；遺失或過期都會在下次讀取時自動修正
+    def _date_rollup_key(self, ds):
+        return f"index/dates/{ds}.json"
+
+    def _iter_reservation_objects(self, prefixes):
+        """
+        列出預約檔，依日期逐一產生 (日期, {key: ETag})。
+        列出結果依 key 排序，同一日期的物件連續出現：出現下一個日期時，前一個日期即已列完，
+        可以先交給呼叫端讀取，不必等整個列出結束
+        """
+        paginator = self.s3_client.get_paginator('list_objects_v2')
+        ds, bucket = None, None
+        for prefix in prefixes:
+            for page in paginator.paginate(Bucket=self.bucket_name, Prefix=prefix):
+                for obj in page.get('Contents', ()):
+                    key = obj['Key']
+                    if key[-5:] != '.json':
+                        continue
+                    key_ds = key[13:].partition('/')[0]  # 去掉 'reservations/' 後的日期資料夾
+                    if key_ds != ds:
+                        if bucket:
+                            yield ds, bucket
+                        ds, bucket = key_ds, {}
+                    bucket[key] = obj['ETag'].strip('"')
+        if bucket:
+            yield ds, bucket
+
+    def _load_from_date_rollups(self, prefixes, max_workers=16):
+        """
+        列出 prefixes 並依各日期的彙總讀取預約 (每個日期一個執行緒)；回傳 (未排序的清單, 列到的日期)。
+        (優化) 邊列出邊讀取：某日期列完就先送出讀取，後續分頁的列出與讀取重疊進行
+        """
+        futures, dates = [], []
+        with ThreadPoolExecutor(max_workers=max_workers) as ex:
+            for item in self._iter_reservation_objects(prefixes):
+                dates.append(item[0])
+                futures.append(ex.submit(self._load_date_rollup, item))
+            reservations = [data for f in futures for data in f.result()]
+        for data in reservations:
+            # 載入時先正規化一次，熱路徑不必每次 str(table_id)
+            data['_tid_str'] = str(data.get('table_id'))
+        return reservations, dates
+
+    def _load_date_rollup(self, item):
+        ds, listed = item
+        # (優化) 該日期的預約檔都沒變：直接沿用上次載入的結果，連彙總都不必讀
+        chunk = self.date_chunks.get(ds)
+        if chunk is not None and chunk[0] == listed:
+            self._remember_slot_dates(listed, ds)
+            return chunk[1]
+        rollup_key = self._date_rollup_key(ds)
+        entries, rollup_etag = {}, None
+        try:
+            resp = self.s3_client.get_object(Bucket=self.bucket_name, Key=rollup_key)
+            # 先取 ETag 再解析：內容損毀時也要以 IfMatch 覆寫修復 (IfNoneMatch 對已存在的物件必定失敗)
+            rollup_etag = resp['ETag']
+            entries = orjson.loads(_read_body(resp))
+            if not isinstance(entries, dict):
+                raise ValueError("rollup is not an object")
+        except self.NoSuchKey:
+            pass
+        except ClientError as e:
+            logger.warning(f"讀取每日彙總失敗 {ds}: {e}")
+        except (ValueError, OSError, EOFError) as e:
+            logger.warning(f"每日彙總格式錯誤 {ds}: {e}")
+            entries = {}
+
+        current = {k: entries[k] for k, etag in listed.items()
+                   if k in entries and entries[k].get('etag') == etag}
+        stale = [k for k in listed if k not in current]
+        if stale:
+            with ThreadPoolExecutor(max_workers=min(8, len(stale))) as ex:
+                for key, (data, etag) in zip(stale, ex.map(self._read_reservation_object, stale)):
+                    if data is not None:
+                        current[key] = {"etag": etag, "data": data}
+
+        self._remember_slot_dates(current, ds)
+
+        # 有新增、變更或已刪除的預約檔時更新彙總；失敗 (其他程序同時更新) 無妨，下次讀取再修正
+        if len(current) != len(entries) or stale:
+            condition = {"IfMatch": rollup_etag} if rollup_etag else {"IfNoneMatch": "*"}
+            _, body, encoding = _encode_aggregate(current)
+            try:
+                self.s3_client.put_object(
+                    Bucket=self.bucket_name,
+                    Key=rollup_key,
+                    Body=body,
+                    ContentType='application/json',
+                    **encoding,
+                    **condition
+                )
+            except ClientError as e:
+                logger.info(f"略過更新每日彙總 {ds}: {e.response['Error']['Code']}")
+        rows = [entry["data"] for entry in current.values()]
+        if len(current) == len(listed):
+            self.date_chunks[ds] = (listed, rows)
+        return rows
+
+    def _remember_slot_dates(self, keys, ds):
+        for key in keys:
+            self._remember_slot_date(key.rpartition('/')[2][:-5], ds)
+
+    def _read_reservation_object(self, key):
+        """讀取單一預約檔，回傳 (內容, ETag)；失敗時記錄並回傳 (None, None)"""
+        try:
+            obj_resp = self.s3_client.get_object(Bucket=self.bucket_name, Key=key)
+            return orjson.loads(obj_resp['Body'].read()), obj_resp['ETag'].strip('"')
+        except Exception as e:
+            logger.warning(f"無法讀取預約檔案 {key}: {e}")
+            return None, None
 
     # -------------- 其它 --------------
     def test_connection(self):
@@ -193,176 +908,246 @@ class S3Store:
             logger.error(f"S3 連線失敗: {e}")
             return False
 
-    # ========== tables.json 作業（最佳努力 CAS） ==========
+    # ========== tables.json 作業（條件寫入 CAS） ==========
 
-    def _head_tables_etag(self):
-        """讀取 tables.json 的當前 ETag（去除引號），不存在時回傳 None"""
-        try:
-            h = self.s3_client.head_object(Bucket=self.bucket_name, Key="tables/tables.json")
-            return h["ETag"].strip('"')
-        except ClientError as e:
-            code = e.response.get("Error", {}).get("Code")
-            if code in ("404", "NoSuchKey"):
+    def get_tables_data(self):
+        """
+        獲取所有桌位資料（不含 ETag），加入 5 秒記憶體快取。
+        回傳的 dict 為共用快取，呼叫端不可修改；需要修改請用 get_tables_data_with_etag。
+        """
+        now = time.monotonic()
+        cached = self.tables_cache
+        if cached is not None and self.tables_expiry > now:
+            return cached
+
+        with self.tables_lock:
+            cached = self.tables_cache
+            if cached is not None and self.tables_expiry > now:
+                return cached
+            try:
+                data, _ = self._fetch_tables(shared=True)
+                self.tables_cache = data
+                self.tables_expiry = now + self.CACHE_TTL_SECONDS
+                return data
+            except self.NoSuchKey:
+                return None
+            except ClientError as e:
+                logger.error(f"獲取桌位資料失敗: {e}")
                 return None
-            raise
 
-    def get_tables_data(self):
-        """獲取所有桌位資料（不含 ETag）"""
+    def peek_tables_data(self):
+        """只回傳仍在有效期內的桌位快取，不發出 S3 請求；沒有時回傳 None。呼叫端不可修改"""
+        cached = self.tables_cache
+        if cached is not None and self.tables_expiry > time.monotonic():
+            return cached
+        return None
+
+    def _fetch_tables(self, shared=False):
+        """
+        讀取 tables.json，回傳 (dict, ETag 去引號)；檔案不存在時照常拋 NoSuchKey。
+        (優化) 以上次的 ETag 做條件 GET (IfNoneMatch)：內容未變時 S3 回 304 不帶內容，
+        直接解析記住的 bytes。預設每次回傳新的 dict (呼叫端可修改)；
+        shared=True 時回傳唯讀的共用 dict，304 時連解析都省下
+        """
+        snapshot = self.tables_raw
+        condition = {"IfNoneMatch": f'"{snapshot[0]}"'} if snapshot else {}
         try:
-            resp = self.s3_client.get_object(Bucket=self.bucket_name, Key="tables/tables.json")
-            return json.loads(resp['Body'].read().decode('utf-8'))
+            resp = self.s3_client.get_object(Bucket=self.bucket_name, Key="tables/tables.json", **condition)
         except ClientError as e:
-            if e.response['Error']['Code'] == 'NoSuchKey':
-                return None
-            logger.error(f"獲取桌位資料失敗: {e}")
-            return None
+            if snapshot and e.response['Error']['Code'] in ('304', 'NotModified'):
+                if shared and snapshot[2] is not None:
+                    return snapshot[2], snapshot[0]
+                data = orjson.loads(snapshot[1])
+                if shared:
+                    self.tables_raw = (snapshot[0], snapshot[1], data)
+                return data, snapshot[0]
+            raise
+        body = _read_body(resp)
+        etag = resp['ETag'].strip('"')
+        data = orjson.loads(body)
+        self.tables_raw = (etag, body, data if shared else None)
+        return data, etag
 
     def get_tables_data_with_etag(self):
         """獲取桌位資料 + ETag（ETag 已去除引號）"""
         try:
-            resp = self.s3_client.get_object(Bucket=self.bucket_name, Key="tables/tables.json")
-            data = json.loads(resp['Body'].read().decode('utf-8'))
-            etag = resp['ETag'].strip('"')
-            return data, etag
+            return self._fetch_tables()
+        except self.NoSuchKey:
+            return None, None
         except ClientError as e:
-            if e.response['Error']['Code'] == 'NoSuchKey':
-                return None, None
             logger.error(f"獲取桌位資料(含ETag) 失敗: {e}")
             return None, None
 
-    def save_tables_data(self, tables_data):
-        """儲存桌位資料（不含 CAS）"""
+    def save_tables_data(self, tables_data, create_only=False):
+        """
+        儲存桌位資料（不含 CAS）；寫入後 tables_data 即成為共用快取，呼叫端不可再修改。
+        create_only=True 時以條件寫入 (IfNoneMatch='*') 只在 tables.json 不存在時建立。
+        """
+        extra = {"IfNoneMatch": "*"} if create_only else {}
+        raw, body, encoding = _encode_aggregate(tables_data, compress=TABLES_JSON_GZIP)
         try:
-            self.s3_client.put_object(
+            resp = self.s3_client.put_object(
                 Bucket=self.bucket_name,
                 Key="tables/tables.json",
-                Body=json.dumps(tables_data, ensure_ascii=False, indent=2),
-                ContentType='application/json'
+                Body=body,
+                ContentType='application/json',
+                **encoding,
+                **extra
             )
+            self._write_through_tables_cache(tables_data, raw, resp)
             return True
         except ClientError as e:
+            if create_only and e.response['Error']['Code'] in ('PreconditionFailed', 'ConditionalRequestConflict'):
+                logger.info("桌位資料已由其他執行個體建立，略過")
+                return False
             logger.error(f"儲存桌位資料失敗: {e}")
             return False
 
     def save_tables_data_cas(self, tables_data, etag_before):
         """
-        最佳努力 CAS：
-        1) 再次 head 取得當前 ETag
-        2) 若與 etag_before 不同 -> 拋 ClientError(PreconditionFailed)
-        3) 若相同 -> 直接 put（S3 PutObject 不支援 IfMatch，只能靠程式層檢查）
-        """
-        logger.info(f"CAS 檢查：etag_before={etag_before}")
-        etag_now = self._head_tables_etag()
-        # 檔案首次建立（etag_none）時允許寫入；若有 etag 就比對
-        if etag_before and etag_now and etag_now != etag_before:
-            raise ClientError(
-                {"Error": {"Code": "PreconditionFailed", "Message": "ETag changed"}}, "PutObject"
+        CAS 寫入：以 S3 條件寫入 (IfMatch=etag_before) 一次完成比對與寫入，
+        期間有其他寫入 (ETag 已變) 時 S3 拒絕並拋 ClientError(PreconditionFailed)。
+        etag_before 為 None (檔案尚未建立) 時改以 IfNoneMatch='*' 建立。
+        寫入後 tables_data 即成為共用快取，呼叫端不可再修改。
+        """
+        logger.info(f"CAS 寫入：etag_before={etag_before}")
+        condition = {"IfMatch": f'"{etag_before}"'} if etag_before else {"IfNoneMatch": "*"}
+        raw, body, encoding = _encode_aggregate(tables_data, compress=TABLES_JSON_GZIP)
+        try:
+            resp = self.s3_client.put_object(
+                Bucket=self.bucket_name,
+                Key="tables/tables.json",
+                Body=body,
+                ContentType="application/json",
+                **encoding,
+                **condition
             )
-
-        self.s3_client.put_object(
-            Bucket=self.bucket_name,
-            Key="tables/tables.json",
-            Body=json.dumps(tables_data, ensure_ascii=False, indent=2),
-            ContentType="application/json"
-        )
+        except ClientError as e:
+            # 同一物件的並行條件寫入 (ConditionalRequestConflict) 或讀取後被刪除 (NoSuchKey)
+            # 都視為 CAS 衝突，呼叫端只需處理 PreconditionFailed
+            if e.response.get("Error", {}).get("Code") in ("ConditionalRequestConflict", "NoSuchKey"):
+                raise ClientError(
+                    {"Error": {"Code": "PreconditionFailed", "Message": "ETag changed"}}, "PutObject"
+                ) from e
+            raise
+        self._write_through_tables_cache(tables_data, raw, resp)
         logger.info("CAS 寫入成功")
         return True
 
-    def reserve_seats_cas(self, table_id, seats_count, retries=5):
+    def release_seats_cas(self, table_id, seats_count, retries=8, reservation_id=None):
         """
-        原子性預訂座位（最佳努力）：讀 -> 算 -> 再 head 比對 -> put；若衝突則退避重試。
+        原子性釋放座位：讀 (含 ETag) -> 算 -> 條件寫入；若衝突則退避重試。
+        帶入 reservation_id 時一併從該桌的預訂摘要移除。
         """
-        key = str(table_id)
+        return self.release_seats_batch_cas(
+            {table_id: seats_count}, retries=retries,
+            reservation_ids=[reservation_id] if reservation_id else None
+        )
+
+    def release_seats_batch_cas(self, seats_by_table, retries=8, reservation_ids=None):
+        """
+        一次釋放多張桌子的座位（單次 CAS 寫入 tables.json）；seats_by_table 為 {table_id: seats}。
+        reservation_ids 內的預訂同時從各桌的預訂摘要移除；桌子帶有預訂摘要時，
+        只歸還摘要中仍存在的預訂座位，已被其他請求取消的預訂不會重複釋放。
+        """
+        releases = {str(t): int(n) for t, n in seats_by_table.items()}
+        removed_ids = set(reservation_ids or ())
+        delay = CAS_BACKOFF_BASE
         for i in range(retries):
             try:
-                etag_before = self._head_tables_etag()
-                obj = self.s3_client.get_object(Bucket=self.bucket_name, Key="tables/tables.json")
-                tables = json.loads(obj["Body"].read().decode("utf-8"))
+                tables, etag_before = self._fetch_tables()
 
-                if key not in tables:
-                    return False
-                curr_left = int(tables[key].get("seats_left", 0))
-                need = int(seats_count)
-                if curr_left < need:
-                    logger.warning(f"CAS 預訂失敗：桌號 {key} 座位不足（剩 {curr_left}，需 {need}）")
+                if any(key not in tables for key in releases):
                     return False
 
-                tables[key]["seats_left"] = curr_left - need
+                applied = {}
+                for key, add in releases.items():
+                    if removed_ids and "reservations" in tables[key]:
+                        kept = []
+                        add = 0
+                        for e in tables[key]["reservations"]:
+                            if e.get("id") in removed_ids:
+                                add += int(e.get("seats", 0))
+                            else:
+                                kept.append(e)
+                        tables[key]["reservations"] = kept
+                    total = int(tables[key].get("total", 10))
+                    curr_left = int(tables[key].get("seats_left", 0))
+                    tables[key]["seats_left"] = min(curr_left + add, total)
+                    applied[key] = add
+
+                if not any(applied.values()):
+                    logger.info("CAS 釋放略過：預訂摘要中已無這些預訂 (已被取消)")
+                    return True
                 self.save_tables_data_cas(tables, etag_before)
-                logger.info(f"CAS 預訂成功：桌號 {key} 扣 {need} -> 剩 {tables[key]['seats_left']}")
+                for key, add in applied.items():
+                    logger.info(f"CAS 釋放成功：桌號 {key} 加 {add} -> 剩 {tables[key]['seats_left']}")
                 return True
 
             except ClientError as e:
                 if e.response.get("Error", {}).get("Code") == "PreconditionFailed":
-                    logger.warning(f"CAS 預訂衝突 (Attempt {i+1}/{retries})，退避重試…")
-                    time.sleep(0.05 * (i + 1))
+                    logger.warning(f"CAS 釋放衝突 (Attempt {i+1}/{retries})，退避重試…")
+                    delay = _cas_backoff(delay)
                     continue
-                logger.error(f"reserve_seats_cas S3 錯誤: {e}")
+                logger.error(f"release_seats_cas S3 錯誤: {e}")
                 return False
             except Exception as e:
-                logger.error(f"reserve_seats_cas 未知錯誤: {e}")
+                logger.error(f"release_seats_cas 未知錯誤: {e}")
                 return False
 
-        logger.warning("reserve_seats_cas 重試耗盡")
+        logger.warning("release_seats_cas 重試耗盡")
         return False
 
-    def release_seats_cas(self, table_id, seats_count, retries=5):
+    def update_table_reservation_cas(self, table_id, reservation_id, seat_diff, name, seats, retries=8):
         """
-        原子性釋放座位（最佳努力）：讀 -> 算 -> 再 head 比對 -> put；若衝突則退避重試。
+        修改預訂時，以單次 CAS 同時調整座位 (seat_diff > 0 為加座，需有足夠空位)
+        與該桌預訂摘要中此筆的姓名/座位數。
         """
         key = str(table_id)
+        need = int(seat_diff)
+        delay = CAS_BACKOFF_BASE
         for i in range(retries):
             try:
-                etag_before = self._head_tables_etag()
-                obj = self.s3_client.get_object(Bucket=self.bucket_name, Key="tables/tables.json")
-                tables = json.loads(obj["Body"].read().decode("utf-8"))
+                tables, etag_before = self._fetch_tables()
 
                 if key not in tables:
                     return False
-
-                total = int(tables[key].get("total", 10))
-                curr_left = int(tables[key].get("seats_left", 0))
-                add = int(seats_count)
-                new_left = min(curr_left + add, total)
-                tables[key]["seats_left"] = new_left
+                table = tables[key]
+                curr_left = int(table.get("seats_left", 0))
+                if need > curr_left:
+                    logger.warning(f"CAS 修改失敗：桌號 {key} 座位不足（剩 {curr_left}，需 {need}）")
+                    return False
+                table["seats_left"] = min(curr_left - need, int(table.get("total", 10)))
+                for entry in table.get("reservations", ()):
+                    if entry.get("id") == reservation_id:
+                        entry["name"] = name
+                        entry["seats"] = seats
 
                 self.save_tables_data_cas(tables, etag_before)
-                logger.info(f"CAS 釋放成功：桌號 {key} 加 {add} -> 剩 {new_left}")
+                logger.info(f"CAS 修改成功：桌號 {key} 座位變動 {need} -> 剩 {table['seats_left']}")
                 return True
 
             except ClientError as e:
                 if e.response.get("Error", {}).get("Code") == "PreconditionFailed":
-                    logger.warning(f"CAS 釋放衝突 (Attempt {i+1}/{retries})，退避重試…")
-                    time.sleep(0.05 * (i + 1))
+                    logger.warning(f"CAS 修改衝突 (Attempt {i+1}/{retries})，退避重試…")
+                    delay = _cas_backoff(delay)
                     continue
-                logger.error(f"release_seats_cas S3 錯誤: {e}")
+                logger.error(f"update_table_reservation_cas S3 錯誤: {e}")
                 return False
             except Exception as e:
-                logger.error(f"release_seats_cas 未知錯誤: {e}")
+                logger.error(f"update_table_reservation_cas 未知錯誤: {e}")
                 return False
 
-        logger.warning("release_seats_cas 重試耗盡")
+        logger.warning("update_table_reservation_cas 重試耗盡")
         return False
 
-    # -------------- login_id 防重複查詢 --------------
-    def check_login_id_exists(self, login_id):
-        """檢查 login_id 是否已存在（使用 get_all_reservations 快取）"""
-        try:
-            reservations = self.get_all_reservations()
-            target = str(login_id).lower()
-            return any((r.get("login_id", "") or "").lower() == target for r in reservations)
-        except Exception as e:
-            logger.error(f"檢查 login_id 失敗: {e}")
-            # 發生錯誤時保守地回 False（讓外層自行決定是否阻擋）
-            return False
-
     # -------------- Idempotency Key --------------
     def save_idempotency_key(self, key, data):
         try:
             self.s3_client.put_object(
                 Bucket=self.bucket_name,
                 Key=f"idempotency/{key}.json",
-                Body=json.dumps(data, ensure_ascii=False, indent=2),
+                Body=orjson.dumps(data),
                 ContentType='application/json'
             )
             return True
@@ -370,15 +1155,79 @@ class S3Store:
             logger.error(f"儲存防重複鍵失敗: {e}")
             return False
 
-    def get_idempotency_key(self, key):
+    # (新) 防重複鍵只需涵蓋客戶端重送的時間窗：交給 S3 Lifecycle 在 1 天後自動刪除，
+    # idempotency/ 不會無限成長
+    _IDEMPOTENCY_RULE_ID = 'expire-idempotency-keys'
+    IDEMPOTENCY_TTL_DAYS = 1
+
+    def ensure_idempotency_lifecycle(self):
+        """
+        確保 bucket 有 idempotency/ 的過期規則；已存在時不動。
+        PutBucketLifecycleConfiguration 會覆蓋整份設定，因此先讀出既有規則再附加。
+        權限不足等錯誤只記錄警告，不影響啟動。
+        """
+        try:
+            try:
+                rules = self.s3_client.get_bucket_lifecycle_configuration(Bucket=self.bucket_name).get('Rules', [])
+            except ClientError as e:
+                if e.response['Error']['Code'] != 'NoSuchLifecycleConfiguration':
+                    raise
+                rules = []
+            if any(r.get('ID') == self._IDEMPOTENCY_RULE_ID for r in rules):
+                return False
+            rules.append({
+                'ID': self._IDEMPOTENCY_RULE_ID,
+                'Filter': {'Prefix': 'idempotency/'},
+                'Status': 'Enabled',
+                'Expiration': {'Days': self.IDEMPOTENCY_TTL_DAYS},
+            })
+            self.s3_client.put_bucket_lifecycle_configuration(
+                Bucket=self.bucket_name,
+                LifecycleConfiguration={'Rules': rules}
+            )
+            logger.info(f"已設定防重複鍵過期規則 ({self.IDEMPOTENCY_TTL_DAYS} 天)")
+            return True
+        except Exception as e:
+            logger.warning(f"設定防重複鍵過期規則失敗: {e}")
+            return False
+
+    def delete_idempotency_key(self, key):
+        try:
+            self.s3_client.delete_object(Bucket=self.bucket_name, Key=f"idempotency/{key}.json")
+        except ClientError as e:
+            logger.error(f"刪除防重複鍵失敗: {e}")
+
+    def claim_idempotency_key(self, key):
+        """
+        以條件寫入 (IfNoneMatch='*') 佔用防重複鍵，取代先讀取再寫入。
+        佔用成功回傳 None；鍵已存在時回傳既有內容的原始 bytes (仍在處理中的請求為 b"{}")。
+        其他 S3 錯誤照常拋出：無法確定是否由本請求建立，不可視同佔用 (否則失敗時會刪掉別人的鍵)。
+        """
+        try:
+            self.s3_client.put_object(
+                Bucket=self.bucket_name,
+                Key=f"idempotency/{key}.json",
+                Body=orjson.dumps({}),
+                ContentType='application/json',
+                IfNoneMatch='*'
+            )
+            return None
+        except ClientError as e:
+            if e.response['Error']['Code'] in ('PreconditionFailed', 'ConditionalRequestConflict'):
+                return self.get_idempotency_body(key) or b"{}"
+            logger.error(f"佔用防重複鍵失敗: {e}")
+            raise
+
+    def get_idempotency_body(self, key):
+        """回傳防重複鍵內容的原始 bytes (不解析)；不存在時回傳 None"""
         try:
             resp = self.s3_client.get_object(
                 Bucket=self.bucket_name,
                 Key=f"idempotency/{key}.json"
             )
-            return json.loads(resp['Body'].read().decode('utf-8'))
+            return resp['Body'].read()
+        except self.NoSuchKey:
+            return None
         except ClientError as e:
-            if e.response['Error']['Code'] == 'NoSuchKey':
-                return None
             logger.error(f"獲取防重複鍵失敗: {e}")
             return None